@@ -0,0 +1,67 @@
+import os
+import sys
+import timeit
+from pathlib import Path
+
+# Add the project folder to PYTHONPATH
+project_dir = str(Path(os.path.abspath(__file__)).parent.parent)
+sys.path.insert(0, project_dir)
+
+from src.core.cryptions import AESCipher, AESContext, AESGCMContext
+
+# The payload sizes to compare the modes on
+PAYLOAD_SIZES = {
+    '100 B': 100,
+    '4 KB': 4 * 1024,
+    '1 MB': 1024 * 1024
+}
+
+
+def bench(func, payload, min_time=0.5):
+    """
+    Measures the average time of a function call on a payload
+    :param func: The function to measure
+    :param payload: The payload to pass to the function
+    :param min_time: The minimal total time (in seconds) to run the function for
+    :return: The average time of a call (in seconds)
+    """
+    timer = timeit.Timer(lambda: func(payload))
+    number, total = timer.autorange()
+    # Run for at least min_time to smooth the noise
+    if total < min_time:
+        number = int(number * min_time / total) + 1
+        total = timer.timeit(number)
+
+    return total / number
+
+
+def main():
+    key = AESCipher.generate_key()
+    cbc = AESContext(key)
+    gcm = AESGCMContext(key)
+
+    # The legacy path: CBC with manual padding, base64 and UTF-8 conversions around the raw ciphertext
+    def legacy_round_trip(payload):
+        return AESCipher.decrypt(key, AESCipher.encrypt(key, payload.decode()))
+
+    def cbc_round_trip(payload):
+        return cbc.decrypt(cbc.encrypt(payload))
+
+    def gcm_round_trip(payload):
+        return gcm.decrypt(gcm.encrypt(payload))
+
+    modes = {
+        'CBC + base64 (legacy)': legacy_round_trip,
+        'CBC raw (v2)': cbc_round_trip,
+        'GCM raw (v2)': gcm_round_trip
+    }
+
+    print(f'{"payload":>8} | ' + ' | '.join(f'{name:>22}' for name in modes))
+    for size_name, size in PAYLOAD_SIZES.items():
+        payload = b'a' * size
+        results = [bench(func, payload) for func in modes.values()]
+        print(f'{size_name:>8} | ' + ' | '.join(f'{result * 1e6:>19.1f} us' for result in results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import socket
+import threading
+import collections
+
+from src.core.cryptions import AESContext, AESGCMContext
+from src.core.framing import FrameDecoder, LEGACY_VERSION, CAP_AES_GCM
+
+
+class ClientConnection:
+    """
+    The state the server keeps for every connected client
+    """
+
+    def __init__(self, client_socket: socket.socket, addr: tuple, key: str, decoder: FrameDecoder,
+                 version: int = LEGACY_VERSION, flags: int = 0):
+        """
+        Creates the state of a connected client
+        :param client_socket: The client's socket
+        :param addr: The client's address (ip, port)
+        :param key: The aes key that was swapped with the client
+        :param decoder: The decoder of the frames the client sends
+        :param version: The framing version that was negotiated with the client
+        :param flags: The capability flags that were negotiated with the client
+        """
+        self.socket = client_socket
+        self.addr = addr
+        self.ip = addr[0]
+        self.key = key
+        # The prepared key material, used for every message of the session
+        self.cipher = AESGCMContext(key) if flags & CAP_AES_GCM else AESContext(key)
+        self.decoder = decoder
+        self.version = version
+        self.flags = flags
+        self.session = None  # The session the connection was bound to (the address of the client's general connection)
+
+        self.lock = threading.Lock()  # Guards the outbound queue's state between the handlers and the event loop
+        self.out_queue = collections.deque()  # The frames that are waiting to be sent to the client
+        self.out_size = 0  # The amount of bytes waiting in the outbound queue
+        self.congested = False  # Whether the outbound queue passed the high watermark and didn't drain yet
+        self.writing = False  # Whether the event loop is watching the socket for writability
+        self.closed = False  # Whether the connection was closed
+        self.transfers = collections.deque()  # The file transfers that are streamed to the client, in order
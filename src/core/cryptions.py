@@ -4,6 +4,7 @@ from Cryptodome.PublicKey import RSA
 from Cryptodome.Cipher import PKCS1_v1_5
 import os
 import hashlib
+import threading
 
 
 class RSACipher:
@@ -12,12 +13,36 @@ class RSACipher:
     """
     KEY_SIZE = 1024*2
 
-    def __init__(self):
+    def __init__(self, rsa_key=None):
         """
         Creates an ASYM object for encryption and decryption
+        :param rsa_key: The RSA keypair to use, a new one is generated if it isn't given
         """
-        self.RSA_key = RSA.generate(RSACipher.KEY_SIZE)
+        self.RSA_key = rsa_key if rsa_key else RSA.generate(RSACipher.KEY_SIZE)
         self.RSA_cipher = PKCS1_v1_5.new(self.RSA_key)
+        # The public key is sent to every client that connects, so export it only once
+        self.string_public_key = self.RSA_key.publickey().exportKey().decode()
+
+    @staticmethod
+    def from_key_file(path: str):
+        """
+        Loads the server's RSA keypair from a PEM file, the keypair is generated and saved on the first run
+        :param path: The path of the PEM file
+        :return: An RSACipher object that uses the keypair
+        """
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                rsa_key = RSA.import_key(f.read())
+        else:
+            rsa_key = RSA.generate(RSACipher.KEY_SIZE)
+            # Write the private key to a temporary file that only the owner can read, then move it into place
+            tmp_path = path + '.tmp'
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(rsa_key.export_key())
+            os.replace(tmp_path, path)
+
+        return RSACipher(rsa_key)
 
     def encrypt(self, data: str, public_key):
         """
@@ -48,7 +73,7 @@ class RSACipher:
         """
         Returns a string representation using PEM encoding for the server's public key
         """
-        return self.RSA_key.publickey().exportKey().decode()
+        return self.string_public_key
 
     def get_public_key_from_string(self, key: str):
         """
@@ -92,7 +117,7 @@ class AESCipher:
         """
         Encrypts the given message using the specified key and returns the encrypted message in base64-encoded form.
         :param key: the encryption key to use
-        :type key: str
+        :type key: str | AESContext
         :param message: the message to encrypt
         :type message: str
         :return: the base64-encoded encrypted message
@@ -100,36 +125,46 @@ class AESCipher:
         """
         byte_array = message.encode("UTF-8")
 
-        padded = AESCipher.pad(byte_array)
-
-        # generate a random iv and prepend that to the encrypted result.
-        # The recipient then needs to unpack the iv and use it.
-        iv = os.urandom(AES.block_size)
-        cipher = AES.new(key.encode("UTF-8"), AES.MODE_CBC, iv)
-        encrypted = cipher.encrypt(padded)
-        # Note we PREPEND the unencrypted iv to the encrypted message
-        return base64.b64encode(iv + encrypted).decode("UTF-8")
+        # Note the unencrypted iv is PREPENDED to the encrypted message
+        return base64.b64encode(AESCipher.encrypt_raw(key, byte_array)).decode("UTF-8")
 
     @staticmethod
     def encrypt_file(key, contents: bytes):
         """
         Encrypts the given file contents using the specified key and returns the encrypted contents in base64-encoded form.
         :param key: the encryption key to use
-        :type key: str
+        :type key: str | AESContext
         :param contents: the contents of the file to encrypt
         :type contents: bytes
         :return: the base64-encoded encrypted file contents
         :rtype: bytes
         """
-        padded = AESCipher.pad(contents)
+        # Note the unencrypted iv is PREPENDED to the encrypted contents
+        return base64.b64encode(AESCipher.encrypt_raw(key, contents))
+
+    @staticmethod
+    def encrypt_raw(key, data: bytes):
+        """
+        Encrypts the given bytes using the specified key and returns the iv and the encrypted bytes,
+        without encoding them in base64.
+        :param key: the encryption key to use
+        :type key: str | AESContext
+        :param data: the bytes to encrypt
+        :type data: bytes
+        :return: the iv followed by the encrypted bytes
+        :rtype: bytes
+        """
+        # A prepared context reuses its cipher
+        if isinstance(key, AESContext):
+            return key.encrypt(data)
+
+        padded = AESCipher.pad(data)
 
         # generate a random iv and prepend that to the encrypted result.
         # The recipient then needs to unpack the iv and use it.
         iv = os.urandom(AES.block_size)
         cipher = AES.new(key.encode("UTF-8"), AES.MODE_CBC, iv)
-        encrypted = cipher.encrypt(padded)
-        # Note we PREPEND the unencrypted iv to the encrypted message
-        return base64.b64encode(iv + encrypted)
+        return iv + cipher.encrypt(padded)
 
     @staticmethod
     def decrypt(key, message):
@@ -137,32 +172,16 @@ class AESCipher:
         Decrypts a given message using the provided key.
 
         :param key: The key used to decrypt the message.
-        :type key: str
+        :type key: str | AESContext
         :param message: The message to be decrypted.
         :type message: str
         :return: The decrypted message.
         :rtype: str
         """
-
         byte_array = base64.b64decode(message)
 
-        # extract the 16-byte initialization vector from the byte array
-        iv = byte_array[0:16]
-
-        # encrypted message is the bit after the iv
-        messagebytes = byte_array[16:]
-
-        # create a new AES cipher with the provided key and iv, in CBC mode
-        cipher = AES.new(key.encode("UTF-8"), AES.MODE_CBC, iv)
-
-        # decrypt the message bytes
-        decrypted_padded = cipher.decrypt(messagebytes)
-
-        # unpad the decrypted message
-        decrypted = AESCipher.unpad(decrypted_padded)
-
         # return the decrypted message as a string
-        return decrypted.decode("UTF-8")
+        return AESCipher.decrypt_raw(key, byte_array).decode("UTF-8")
 
     @staticmethod
     def decrypt_file(key, contents: bytes):
@@ -170,7 +189,7 @@ class AESCipher:
         Decrypts the contents of a file using the provided key.
 
         :param key: The key used to decrypt the file.
-        :type key: str
+        :type key: str | AESContext
         :param contents: The contents of the encrypted file.
         :type contents: bytes
         :return: The decrypted contents of the file.
@@ -178,23 +197,32 @@ class AESCipher:
         """
         contents = base64.b64decode(contents)
 
-        # extract the 16-byte initialization vector from the byte array
-        iv = contents[0:16]
+        # return the decrypted contents of the file as bytes
+        return AESCipher.decrypt_raw(key, contents)
+
+    @staticmethod
+    def decrypt_raw(key, data: bytes):
+        """
+        Decrypts bytes that were encrypted by encrypt_raw (the iv followed by the encrypted bytes).
+        :param key: The key used to decrypt the data.
+        :type key: str | AESContext
+        :param data: The iv followed by the encrypted bytes.
+        :type data: bytes
+        :return: The decrypted bytes.
+        :rtype: bytes
+        """
+        # A prepared context reuses its cipher
+        if isinstance(key, AESContext):
+            return key.decrypt(data)
 
-        # encrypted message is the bit after the iv
-        messagebytes = contents[16:]
+        # extract the 16-byte initialization vector from the byte array
+        iv = data[0:16]
 
         # create a new AES cipher with the provided key and iv, in CBC mode
         cipher = AES.new(key.encode("UTF-8"), AES.MODE_CBC, iv)
 
-        # decrypt the message bytes
-        decrypted_padded = cipher.decrypt(messagebytes)
-
-        # unpad the decrypted message
-        decrypted = AESCipher.unpad(decrypted_padded)
-
-        # return the decrypted contents of the file as bytes
-        return decrypted
+        # decrypt the message bytes (the bit after the iv) and unpad them
+        return AESCipher.unpad(cipher.decrypt(data[16:]))
 
     @staticmethod
     def generate_key():
@@ -204,3 +232,115 @@ class AESCipher:
         """
         return hashlib.sha256(os.urandom(32)).hexdigest()[:32]
 
+
+
+class AESContext:
+    """
+    The AES key material of one session. The key is encoded and expanded once, and the CBC ciphers
+    are kept for the whole session instead of creating new ones for every message.
+    The output is the same as AESCipher's: the iv followed by the encrypted bytes.
+    """
+    COPY_LIMIT = 64 * 1024  # Data smaller than this is copied and encrypted in a single call
+
+    def __init__(self, key: str):
+        """
+        Creates the context of an AES key
+        :param key: the AES key
+        :type key: str
+        """
+        self.key = key
+        self.key_bytes = key.encode("UTF-8")
+        # The ciphers continue the CBC chain from message to message, so they are used under a lock
+        self.lock = threading.Lock()
+        self.encryptor = AES.new(self.key_bytes, AES.MODE_CBC, os.urandom(AES.block_size))
+        self.decryptor = AES.new(self.key_bytes, AES.MODE_CBC, os.urandom(AES.block_size))
+
+    def encrypt(self, data):
+        """
+        Encrypts bytes, same as AESCipher.encrypt_raw
+        :param data: the bytes to encrypt, a memoryview (of an mmap for example) is encrypted without copying it
+        :type data: bytes | memoryview
+        :return: the iv followed by the encrypted bytes
+        :rtype: bytes
+        """
+        # Encrypting a random block first makes its encryption an unpredictable iv for the rest of the chain,
+        # so the chain can be continued instead of starting a new cipher with a new iv
+        if len(data) < AESContext.COPY_LIMIT:
+            # Copying small data is cheaper than encrypting it in parts
+            padded = os.urandom(AES.block_size) + AESCipher.pad(data if type(data) == bytes else bytes(data))
+            with self.lock:
+                return self.encryptor.encrypt(padded)
+
+        # Only the last partial block of big data is copied for the padding
+        full_size = len(data) - len(data) % AES.block_size
+        last_block = AESCipher.pad(bytes(data[full_size:]))
+
+        with self.lock:
+            encrypted = self.encryptor.encrypt(os.urandom(AES.block_size))
+            if full_size:
+                encrypted += self.encryptor.encrypt(data[:full_size])
+            return encrypted + self.encryptor.encrypt(last_block)
+
+    def decrypt(self, data: bytes):
+        """
+        Decrypts bytes, same as AESCipher.decrypt_raw
+        :param data: the iv followed by the encrypted bytes
+        :type data: bytes
+        :return: the decrypted bytes
+        :rtype: bytes
+        """
+        # Decrypting the iv as a block makes it the previous block of the chain,
+        # the block it decrypts to is thrown away
+        with self.lock:
+            decrypted = self.decryptor.decrypt(data)
+        return AESCipher.unpad(decrypted[AES.block_size:])
+
+
+class AESGCMContext:
+    """
+    The AES key material of one session in GCM mode (authenticated encryption).
+    Works on bytes (or memoryviews) end to end: no padding, no base64 and no separate MAC.
+    The output is the nonce, the encrypted bytes and the tag.
+    """
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+
+    def __init__(self, key: str):
+        """
+        Creates the context of an AES key
+        :param key: the AES key
+        :type key: str
+        """
+        self.key = key
+        self.key_bytes = key.encode("UTF-8")
+
+    def encrypt(self, data):
+        """
+        Encrypts and authenticates bytes
+        :param data: the bytes to encrypt
+        :type data: bytes | memoryview
+        :return: the nonce, the encrypted bytes and the tag
+        :rtype: bytes
+        """
+        # Both sides encrypt with the session key, so the nonce is random instead of a counter
+        nonce = os.urandom(AESGCMContext.NONCE_SIZE)
+        cipher = AES.new(self.key_bytes, AES.MODE_GCM, nonce=nonce)
+        encrypted, tag = cipher.encrypt_and_digest(data)
+        return nonce + encrypted + tag
+
+    def decrypt(self, data):
+        """
+        Decrypts bytes and checks that they weren't tampered with
+        :param data: the nonce, the encrypted bytes and the tag
+        :type data: bytes | memoryview
+        :return: the decrypted bytes
+        :rtype: bytes
+        :raises ValueError: If the data was tampered with
+        """
+        data = memoryview(data)
+        if len(data) < AESGCMContext.NONCE_SIZE + AESGCMContext.TAG_SIZE:
+            raise ValueError('Data is too short')
+
+        cipher = AES.new(self.key_bytes, AES.MODE_GCM, nonce=data[:AESGCMContext.NONCE_SIZE])
+        return cipher.decrypt_and_verify(data[AESGCMContext.NONCE_SIZE:-AESGCMContext.TAG_SIZE],
+                                         data[-AESGCMContext.TAG_SIZE:])
@@ -0,0 +1,283 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+
+class LatencyStats:
+    """
+    The latency of the handled operations, by opname (not thread-safe, the dispatchers hold their lock)
+    """
+
+    def __init__(self):
+        """
+        Creates empty stats
+        """
+        self.latencies = {}  # The latency of every opname: [count, total wait, max wait, total run, max run]
+
+    def record(self, opname: str, wait: float, run: float):
+        """
+        Adds a handler's latency
+        :param opname: The name of the handled operation
+        :param wait: The time the handler was queued (in seconds)
+        :param run: The time the handler ran (in seconds)
+        :return: -
+        """
+        latency = self.latencies.get(opname)
+        if latency is None:
+            latency = self.latencies[opname] = [0, 0, 0, 0, 0]
+        latency[0] += 1
+        latency[1] += wait
+        latency[2] = max(latency[2], wait)
+        latency[3] += run
+        latency[4] = max(latency[4], run)
+
+    def summary(self) -> dict:
+        """
+        Returns the latency of every opname
+        :return: A dict with the count and the average and max wait and run times of every opname (in seconds)
+        """
+        return {opname: {'count': count, 'avg_wait': total_wait / count, 'max_wait': max_wait,
+                         'avg_run': total_run / count, 'max_run': max_run}
+                for opname, (count, total_wait, max_wait, total_run, max_run) in self.latencies.items()}
+
+
+class OrderedDispatcher:
+    """
+    Runs handlers on a pool of worker threads, while the handlers of the same key (for example the same client)
+    run one at a time and in the order they were submitted.
+    Every key with pending handlers is in the ready queue at most once, so one key never occupies two workers.
+    """
+
+    WORKERS = max(4, os.cpu_count() or 1)  # The default amount of worker threads
+
+    def __init__(self, name, workers=WORKERS, log=False):
+        """
+        Creates the dispatcher, the workers start with start()
+        :param name: The dispatcher's name (for the threads' names and the log)
+        :param workers: The amount of worker threads
+        :param log: Whether to print the handlers that failed
+        """
+        self.name = name
+        self.workers = workers
+        self.log = log
+
+        self.lock = threading.Lock()
+        self.drained = threading.Condition(self.lock)  # Notified when no handlers are queued
+        self.pending = {}  # The queued handlers of every key (opname, handler, args, submit time)
+        self.ready = queue.Queue()  # The keys that have queued handlers and aren't running
+        self.threads = []
+
+        # Metrics
+        self.depth = 0  # The amount of queued handlers
+        self.max_depth = 0  # The largest amount of queued handlers
+        self.errors = 0  # The amount of handlers that raised
+        self.latencies = LatencyStats()
+
+    def start(self):
+        """
+        Starts the worker threads
+        :return: -
+        """
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._main, name=f'{self.name}-{i}')
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, opname: str, handler, *args):
+        """
+        Queues a handler after the handlers of the same key
+        :param key: The key that orders the handlers (the client's ip)
+        :param opname: The name of the handled operation (for the metrics)
+        :param handler: The handler function
+        :param args: The handler's arguments
+        :return: -
+        """
+        with self.lock:
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+
+            tasks = self.pending.get(key)
+            if tasks is None:
+                # The key has nothing queued or running, so it's ready
+                self.pending[key] = deque([(opname, handler, args, time.monotonic())])
+                self.ready.put(key)
+            else:
+                # The key's worker runs it after the queued handlers
+                tasks.append((opname, handler, args, time.monotonic()))
+
+    def close(self):
+        """
+        Stops the worker threads after the queued handlers
+        :return: -
+        """
+        # Re-queued keys would be behind the stop signals, so wait for the queued handlers first
+        with self.drained:
+            self.drained.wait_for(lambda: not self.pending)
+        for thread in self.threads:
+            self.ready.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self) -> dict:
+        """
+        Returns the dispatcher's metrics
+        :return: A dict with the queue depth, the amount of errors and the latency of every opname (in seconds)
+        """
+        with self.lock:
+            return {'workers': self.workers, 'depth': self.depth, 'max_depth': self.max_depth,
+                    'keys': len(self.pending), 'errors': self.errors, 'latencies': self.latencies.summary()}
+
+    def _main(self):
+        """
+        Runs the handlers of the ready keys, one handler at a time
+        :return: -
+        """
+        while True:
+            key = self.ready.get()
+            if key is None:
+                break
+
+            with self.lock:
+                opname, handler, args, submit_time = self.pending[key][0]
+
+            start = time.monotonic()
+            try:
+                handler(*args)
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                if self.log:
+                    print(f'{self.name.upper()}: {opname} failed -', e)
+            end = time.monotonic()
+
+            with self.lock:
+                self.depth -= 1
+                self.latencies.record(opname, start - submit_time, end - start)
+
+                tasks = self.pending[key]
+                tasks.popleft()
+                if tasks:
+                    # Let other keys run before the key's next handler
+                    self.ready.put(key)
+                else:
+                    del self.pending[key]
+                    if not self.pending:
+                        self.drained.notify_all()
+
+
+class ShardedDispatcher:
+    """
+    Runs handlers on a fixed set of shards, every shard is a worker thread with its own queue.
+    A key (for example a chat id) is always handled by the same shard, so the handlers of a key run in order,
+    while the handlers of keys of different shards run in parallel.
+    """
+
+    SHARDS = max(4, os.cpu_count() or 1)  # The default amount of shards
+
+    def __init__(self, name, shards=SHARDS, log=False):
+        """
+        Creates the dispatcher, the shards start with start()
+        :param name: The dispatcher's name (for the threads' names and the log)
+        :param shards: The amount of shards (worker threads)
+        :param log: Whether to print the handlers that failed
+        """
+        self.name = name
+        self.log = log
+
+        self.lock = threading.Lock()  # Guards the metrics
+        self.queues = [queue.Queue() for i in range(shards)]  # The queued handlers of every shard
+        self.threads = []
+
+        # Metrics of every shard
+        self.max_depths = [0] * shards  # The largest amount of queued handlers
+        self.handled = [0] * shards  # The amount of handlers that ran
+        self.errors = [0] * shards  # The amount of handlers that raised
+        self.latencies = LatencyStats()
+
+    def start(self):
+        """
+        Starts the shards' threads
+        :return: -
+        """
+        for shard, shard_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._main, args=(shard, shard_queue), name=f'{self.name}-{shard}')
+            thread.start()
+            self.threads.append(thread)
+
+    def shard_of(self, key) -> int:
+        """
+        Returns the shard of a key
+        :param key: The key (an int or a string, 5 and '5' are the same key)
+        :return: The shard's index
+        """
+        return hash(str(key)) % len(self.queues)
+
+    def submit(self, key, opname: str, handler, *args):
+        """
+        Queues a handler on the shard of its key
+        :param key: The key that orders the handlers (the chat id)
+        :param opname: The name of the handled operation (for the metrics)
+        :param handler: The handler function
+        :param args: The handler's arguments
+        :return: -
+        """
+        shard = self.shard_of(key)
+        shard_queue = self.queues[shard]
+        shard_queue.put((opname, handler, args, time.monotonic()))
+
+        depth = shard_queue.qsize()
+        if depth > self.max_depths[shard]:
+            with self.lock:
+                self.max_depths[shard] = max(self.max_depths[shard], depth)
+
+    def close(self):
+        """
+        Stops the shards' threads after the queued handlers
+        :return: -
+        """
+        for shard_queue in self.queues:
+            shard_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self) -> dict:
+        """
+        Returns the dispatcher's metrics
+        :return: A dict with the queue depth, the max depth, the amount of handled handlers and errors of every shard,
+        and the latency of every opname (in seconds)
+        """
+        with self.lock:
+            shards = [{'depth': shard_queue.qsize(), 'max_depth': self.max_depths[shard],
+                       'handled': self.handled[shard], 'errors': self.errors[shard]}
+                      for shard, shard_queue in enumerate(self.queues)]
+            return {'shards': shards, 'latencies': self.latencies.summary()}
+
+    def _main(self, shard: int, shard_queue: queue.Queue):
+        """
+        Runs the handlers of a shard in order
+        :param shard: The shard's index
+        :param shard_queue: The shard's queue
+        :return: -
+        """
+        while True:
+            task = shard_queue.get()
+            if task is None:
+                break
+
+            opname, handler, args, submit_time = task
+            start = time.monotonic()
+            failed = False
+            try:
+                handler(*args)
+            except Exception as e:
+                failed = True
+                if self.log:
+                    print(f'{self.name.upper()}: {opname} failed -', e)
+            end = time.monotonic()
+
+            with self.lock:
+                self.handled[shard] += 1
+                self.errors[shard] += failed
+                self.latencies.record(opname, start - submit_time, end - start)
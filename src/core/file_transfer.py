@@ -0,0 +1,71 @@
+import os
+import mmap
+import time
+
+
+class FileTransfer:
+    """
+    A stored file (or a byte range of it) that is pushed to a client in chunks by the event loop.
+    The file is memory-mapped, so every chunk is a slice of the page cache that is encrypted without copying it.
+    """
+
+    def __init__(self, path: str, message: str, offset: int = 0, length: int = None):
+        """
+        Opens a file for a transfer
+        :param path: The path of the file
+        :param message: The protocol message that is sent before the file's chunks
+        :param offset: The offset of the first byte to send
+        :param length: The amount of bytes to send, defaults to the rest of the file
+        """
+        self.path = path
+        self.message = message
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        # An empty file can't be mapped
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.view = memoryview(self.map) if self.map else None
+        # The range of the file to send
+        self.start = min(offset, self.size)
+        self.end = self.size if length is None else min(self.start + length, self.size)
+        self.offset = self.start  # The offset of the next byte to hand to the event loop
+        self.started = False  # Whether the message before the chunks was sent
+        self.start_time = None  # The time the first chunk was produced
+
+    def next_chunk(self, chunk_size: int):
+        """
+        Returns the next slice of the file
+        :param chunk_size: The max size of the slice
+        :return: A memoryview of the next slice of the file
+        """
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+
+        chunk = self.view[self.offset:min(self.offset + chunk_size, self.end)]
+        self.offset += len(chunk)
+        return chunk
+
+    def is_done(self) -> bool:
+        """
+        Checks if all the range was handed to the event loop
+        """
+        return self.started and self.offset >= self.end
+
+    def progress(self) -> dict:
+        """
+        Returns the progress of the transfer
+        :return: A dict with the path, the range's offset and length, the amount of bytes that were sent
+        and the time it took so far
+        """
+        elapsed = time.monotonic() - self.start_time if self.start_time is not None else 0
+        return {'path': self.path, 'offset': self.start, 'length': self.end - self.start,
+                'sent': self.offset - self.start, 'elapsed': elapsed}
+
+    def close(self):
+        """
+        Closes the file of the transfer
+        """
+        if self.view is not None:
+            self.view.release()
+            self.map.close()
+            self.view = None
+        self.file.close()
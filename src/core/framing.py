@@ -0,0 +1,139 @@
+import struct
+
+# The first bytes of a protocol v2 handshake hello and of every v2 frame header
+MAGIC = b'SF'
+# The framing versions
+LEGACY_VERSION = 1
+VERSION_2 = 2
+# The hello a client sends before its public key to ask for v2 framing, and the server's answer:
+# magic, version, flags
+HELLO_FORMAT = struct.Struct('!2sBB')
+# The capability flags of the hello
+CAP_AES_GCM = 0x01  # Encrypt the session with AES-GCM instead of AES-CBC
+# The flags of a v2 frame
+FRAME_FLAG_CHUNK = 0x01  # The frame carries raw bytes of a file transfer instead of a protocol message
+
+
+class FrameDecoder:
+    """
+    An incremental decoder for the size-prefixed frames that clients send to the server.
+    Every frame is built from a zero-padded decimal size header and a body of that size.
+    """
+
+    # The states of the decoder
+    READING_HEADER = 0
+    READING_BODY = 1
+
+    def __init__(self, header_size: int, max_size: int):
+        """
+        Creates a decoder for one connection
+        :param header_size: The length of the size header (in bytes)
+        :param max_size: The biggest body size that is allowed
+        """
+        self.header_size = header_size
+        self.max_size = max_size
+        self.buffer = bytearray()  # The bytes that were received and weren't decoded yet
+        self.state = FrameDecoder.READING_HEADER
+        self.body_size = 0  # The size of the body that is being read
+        self.flags = 0  # The flags of the frame that is being read
+
+    def feed(self, data: bytes) -> list:
+        """
+        Adds received bytes to the decoder and decodes every frame that was completed
+        :param data: The bytes that were received from the socket
+        :return: A list of (flags, body) of the completed frames
+        :raises ValueError: If the header of a frame is invalid or too big
+        """
+        self.buffer += data
+        frames = []
+        offset = 0
+
+        while True:
+            if self.state == FrameDecoder.READING_HEADER:
+                # Wait for the rest of the header
+                if len(self.buffer) - offset < self.header_size:
+                    break
+
+                header = bytes(self.buffer[offset:offset + self.header_size])
+                offset += self.header_size
+                self.flags, self.body_size = self._parse_header(header)
+                if self.body_size > self.max_size:
+                    raise ValueError(f'Frame of {self.body_size} bytes is bigger than the max size')
+                self.state = FrameDecoder.READING_BODY
+
+            else:
+                # Wait for the rest of the body
+                if len(self.buffer) - offset < self.body_size:
+                    break
+
+                frames.append((self.flags, bytes(self.buffer[offset:offset + self.body_size])))
+                offset += self.body_size
+                self.state = FrameDecoder.READING_HEADER
+
+        # Drop the decoded bytes from the buffer
+        if offset:
+            del self.buffer[:offset]
+
+        return frames
+
+    def _parse_header(self, header: bytes) -> tuple:
+        """
+        Parses the size header of a frame
+        :param header: The header's bytes
+        :return: The flags of the frame (always 0) and the size of its body
+        :raises ValueError: If the header is invalid
+        """
+        # Only plain digits are allowed (int() would also accept signs and spaces)
+        if not header.isdigit():
+            raise ValueError(f'Invalid frame header: {header!r}')
+
+        return 0, int(header)
+
+    @staticmethod
+    def encode(body: bytes, header_size: int) -> bytes:
+        """
+        Builds a frame
+        :param body: The body of the frame
+        :param header_size: The length of the size header (in bytes)
+        :return: The frame's bytes
+        """
+        return str(len(body)).zfill(header_size).encode() + body
+
+
+class BinaryFrameDecoder(FrameDecoder):
+    """
+    An incremental decoder for protocol v2 frames.
+    Every frame is built from a fixed binary header (magic, version, flags, u32 body length) and the body.
+    """
+
+    HEADER_FORMAT = struct.Struct('!2sBBI')
+
+    def __init__(self, max_size: int):
+        """
+        Creates a decoder for one connection
+        :param max_size: The biggest body size that is allowed
+        """
+        super().__init__(BinaryFrameDecoder.HEADER_FORMAT.size, max_size)
+
+    def _parse_header(self, header: bytes) -> tuple:
+        """
+        Parses the binary header of a frame
+        :param header: The header's bytes
+        :return: The flags of the frame and the size of its body
+        :raises ValueError: If the header is invalid
+        """
+        magic, version, flags, size = BinaryFrameDecoder.HEADER_FORMAT.unpack(header)
+        if magic != MAGIC or version != VERSION_2:
+            raise ValueError(f'Invalid frame header: {header!r}')
+
+        return flags, size
+
+    @staticmethod
+    def encode(body: bytes, flags: int = 0) -> bytes:
+        """
+        Builds a frame
+        :param body: The body of the frame
+        :param flags: The flags of the frame
+        :return: The frame's bytes
+        """
+        return BinaryFrameDecoder.HEADER_FORMAT.pack(MAGIC, VERSION_2, flags, len(body)) + body
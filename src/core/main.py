@@ -10,10 +10,15 @@ import sys
 project_dir = str(Path(os.path.abspath(__file__)).parent.parent.parent)
 sys.path.insert(0, project_dir)
 
+from src.core.dispatcher import OrderedDispatcher, ShardedDispatcher
+from src.core.framing import VERSION_2
 from src.core.server_com import ServerCom
+from src.core.presence import PresenceRegistry
 from src.core.server_protocol import Protocol
-from src.handlers.db import DBHandler
-from src.core.cryptions import AESCipher
+from src.core.transfer_scheduler import TransferScheduler
+from src.handlers.db_pool import DBPool
+from src.handlers.db_writer import DBWriter
+from src.core.cryptions import AESCipher, RSACipher
 from src.handlers.file_handler import FileHandler
 
 
@@ -75,18 +80,18 @@ def handle_register(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
     # Check if the user is already logged in
-    if ip in logged_in_users.keys():
+    if presence.is_logged_in(ip):
         com.send_data(Protocol.reject(params['opcode']), ip)
 
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         username = str(params['username'])
         password = str(params['password'])
 
@@ -120,31 +125,37 @@ def handle_login(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
     # Check if the user is already logged in
-    if ip in logged_in_users.keys():
+    if presence.is_logged_in(ip):
         com.send_data(Protocol.reject(params['opcode']), ip)
 
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         username = str(params['username'])
         password = str(params['password'])
         hashed_password = hashlib.sha256(password.encode()).hexdigest()
-        if username in logged_in_users.values():
-            flag = False
-        else:
-            flag = db_handle.check_credentials(username, hashed_password)
+        flag = db_handle.check_credentials(username, hashed_password)
+        # Add the session of the user to the logged-in users (it fails if the user has too many sessions)
+        if flag:
+            # A user that is offline when a key is queued for him gets it on this login
+            with pending_lock:
+                flag = presence.login(ip, username, password)
         if flag:
             approve_msg = Protocol.approve(params['opcode'])
             com.send_data(approve_msg, ip)
-            # Add the user to the dict of logged-in users with his ip as the key and username as value
-            logged_in_users[ip] = username
-            logged_in_passwords[ip] = password
+
+            # Bind the client's chats and files connections to the session by its ip,
+            # v2 clients can bind them with the session's token instead (clients behind the same ip can't be told apart)
+            chat_com.bind_first_unbound(ip[0], ip)
+            files_com.bind_first_unbound(ip[0], ip)
+            if com.get_version(ip) == VERSION_2:
+                com.send_data(Protocol.session_token(presence.get_token(ip)), ip)
 
             # Start a thread to send the pending friend requests and messages after waiting for 2 seconds
             send_pending_friend_requests(username, com)
@@ -173,42 +184,45 @@ def handle_friend_add(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
     # Check if the user is logged in
-    if ip in logged_in_users.keys():
-        db_handle = DBHandler('strife_db')
+    if presence.is_logged_in(ip):
+        db_handle = db_pool.get()
         friend_username = str(params['friend_username'])
-        adder_username = logged_in_users[ip]
+        adder_username = presence.get_username(ip)
 
         # Check if the user is trying to add himself
         if adder_username == friend_username:
             com.send_data(Protocol.reject(params['opcode']), ip)
             return
 
-        # Check if the friend request is already pending
-        is_already_pending = (
-                                     adder_username in pending_friend_requests.keys() and
-                                     pending_friend_requests[adder_username] == friend_username
-                             ) or (
-                                     friend_username in pending_friend_requests.keys() and
-                                     pending_friend_requests[friend_username] == adder_username
-                             )
-
-        # Check if the friend request is valid
-        if db_handle.can_add_friend(adder_username, friend_username) and not is_already_pending:
-            friend_ip = get_ip_by_username(friend_username)
+        can_add = db_handle.can_add_friend(adder_username, friend_username)
+        with pending_lock:
+            # Check if the friend request is already pending
+            is_already_pending = (
+                                         adder_username in pending_friend_requests.keys() and
+                                         pending_friend_requests[adder_username] == friend_username
+                                 ) or (
+                                         friend_username in pending_friend_requests.keys() and
+                                         pending_friend_requests[friend_username] == adder_username
+                                 )
+
+            # Add the friend request to the pending requests if it's valid
+            is_valid = can_add and not is_already_pending
+            if is_valid:
+                pending_friend_requests[adder_username] = friend_username
+
+        if is_valid:
+            friend_ips = presence.get_sessions(friend_username)
             # Send the friend request to the friend
-            if friend_ip:
+            if friend_ips:
                 msg = Protocol.friend_request_notify(adder_username, silent=False)
-                com.send_data(msg, friend_ip)
-
-            # Add the friend request to the pending requests
-            pending_friend_requests[adder_username] = friend_username
+                com.send_data(msg, friend_ips)
 
         else:
             com.send_data(Protocol.reject(params['opcode']), ip)
@@ -227,24 +241,29 @@ def handle_friend_accept(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    if ip in logged_in_users.keys():
+    if presence.is_logged_in(ip):
         # Get the username of the sender
-        username = logged_in_users[ip]
+        username = presence.get_username(ip)
         # Get the username of the friend
         friend_username = str(params['friend_username'])
 
         # Check if the friend request is accepted
         if bool(params['is_accepted']):
-            # Check if the friend request is pending
-            if friend_username in pending_friend_requests.keys() \
-                    and pending_friend_requests[friend_username] == username:
-                db_handle = DBHandler('strife_db')
+            # Check if the friend request is pending, and take it so it's accepted only once
+            with pending_lock:
+                is_pending = friend_username in pending_friend_requests.keys() \
+                             and pending_friend_requests[friend_username] == username
+                if is_pending:
+                    del pending_friend_requests[friend_username]
+
+            if is_pending:
+                db_handle = db_pool.get()
                 # Add the friend to the database and create a chat for them
                 chat_id = db_handle.add_friend(username, friend_username)
                 # Create a chat folder for the chat
@@ -257,21 +276,22 @@ def handle_friend_accept(com, chat_com, files_com, ip, params):
                 com.send_data(msg, ip)
 
                 # Add the key to the database
-                db_handle.add_key(username, chat_id, friends_key, logged_in_passwords[ip])
+                db_writer.submit('add_key', username, chat_id, friends_key, presence.get_password(ip)).result()
 
                 # Send the friend added message to the user
                 msg = Protocol.friend_added(username, friends_key, chat_id)
-                friend_ip = get_ip_by_username(friend_username)
-                if friend_ip:
-                    com.send_data(msg, get_ip_by_username(friend_username))
-                    db_handle.add_key(friend_username, chat_id, friends_key, logged_in_passwords[friend_ip])
-
-                else:
-                    # If the friend is not online, add the message to his pending messages
-                    add_pending_message(msg, friend_username)
-                    add_pending_key(friends_key, chat_id, friend_username)
-
-                del pending_friend_requests[friend_username]
+                # If the friend is not online, add the message to his pending messages
+                # (checked under the lock, so a login in between gets the key)
+                with pending_lock:
+                    friend_ips = presence.get_sessions(friend_username)
+                    if not friend_ips:
+                        add_pending_message(msg, friend_username)
+                        add_pending_key(friends_key, chat_id, friend_username)
+
+                if friend_ips:
+                    com.send_data(msg, friend_ips)
+                    db_writer.submit('add_key', friend_username, chat_id, friends_key,
+                                     presence.get_user_password(friend_username)).result()
             else:
                 com.send_data(Protocol.reject(params['opcode']), ip)
     else:
@@ -288,17 +308,17 @@ def handle_friend_remove(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
     # Check if the user is logged in
-    if ip in logged_in_users.keys():
-        db_handle = DBHandler('strife_db')
+    if presence.is_logged_in(ip):
+        db_handle = db_pool.get()
         friend_username = str(params['friend_username'])
-        remover_username = logged_in_users[ip]
+        remover_username = presence.get_username(ip)
 
         db_handle.remove_friend(remover_username, friend_username)
     else:
@@ -315,20 +335,20 @@ def handle_group_creation(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
     # Check if the user is logged in
-    if ip in logged_in_users.keys():
-        db_handle = DBHandler('strife_db')
+    if presence.is_logged_in(ip):
+        db_handle = db_pool.get()
 
         group_name = str(params['group_name'])
         group_key = AESCipher.generate_key()
 
-        creator_username = logged_in_users[ip]
+        creator_username = presence.get_username(ip)
         # Create the group and save its id
         group_id = db_handle.create_group(group_name, creator_username)
         if group_id == -1:
@@ -339,7 +359,7 @@ def handle_group_creation(com, chat_com, files_com, ip, params):
             # Create a message that indicates that the creator of the group was added to the group
             msg = Protocol.added_to_group(group_name, group_id, group_key)
             # Add the key to the database
-            db_handle.add_key(creator_username, group_id, group_key, logged_in_passwords[ip])
+            db_writer.submit('add_key', creator_username, group_id, group_key, presence.get_password(ip)).result()
             # Send the message to the client (creator)
             com.send_data(msg, ip)
     else:
@@ -356,20 +376,20 @@ def handle_add_group_member(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
     # Check if the user is logged in
-    if ip in logged_in_users.keys():
-        db_handle = DBHandler('strife_db')
+    if presence.is_logged_in(ip):
+        db_handle = db_pool.get()
 
         chat_id = params['chat_id']
         username = str(params['new_member_username'])
         group_key = str(params['group_key'])
-        adder = logged_in_users[ip]
+        adder = presence.get_username(ip)
 
         # Add the user to the group in the database and check if the operation was successful
         flag = db_handle.add_to_group(chat_id, adder, username)
@@ -378,17 +398,21 @@ def handle_add_group_member(com, chat_com, files_com, ip, params):
         if flag:
             added_msg = Protocol.added_to_group(db_handle.get_group_name(chat_id), chat_id, group_key)
             # Add the key to the database
-            db_handle.add_key(adder, chat_id, group_key, logged_in_passwords[ip])
+            db_writer.submit('add_key', adder, chat_id, group_key, presence.get_password(ip)).result()
 
-            user_ip = get_ip_by_username(username)
-            if user_ip:
+            # If the user is not online, add the message to his pending messages
+            # (checked under the lock, so a login in between gets the key)
+            with pending_lock:
+                user_ips = presence.get_sessions(username)
+                if not user_ips:
+                    add_pending_message(added_msg, username)
+                    add_pending_key(group_key, chat_id, username)
+
+            if user_ips:
                 # Send the message to the user
-                com.send_data(added_msg, get_ip_by_username(username))
-                db_handle.add_key(username, chat_id, group_key, logged_in_passwords[user_ip])
-            else:
-                # If the user is not online, add the message to his pending messages
-                add_pending_message(added_msg, username)
-                add_pending_key(group_key, chat_id, username)
+                com.send_data(added_msg, user_ips)
+                db_writer.submit('add_key', username, chat_id, group_key,
+                                 presence.get_user_password(username)).result()
 
             # Send the group members to the user
             send_group_members(com, chat_id)
@@ -410,17 +434,17 @@ def handle_request_chats(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
     # Check if the user is logged in
-    if ip in logged_in_users.keys():
-        db_handle = DBHandler('strife_db')
+    if presence.is_logged_in(ip):
+        db_handle = db_pool.get()
 
-        username = logged_in_users[ip]
+        username = presence.get_username(ip)
         # Get the user's chats
         chats = db_handle.get_chats_of(username)
         # Check if the user has any chats
@@ -443,17 +467,17 @@ def handle_username_change(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
     com.send_data(Protocol.reject(params['opcode']), ip)
 
-    # db_handle = DBHandler('strife_db')
+    # db_handle = db_pool.get()
     # new_username = str(params['new_username'])
-    # old_username = logged_in_users[ip]
+    # old_username = presence.get_username(ip)
     #
     # # Check if the new username is valid
     # if not check_username(new_username):
@@ -461,7 +485,7 @@ def handle_username_change(com, chat_com, files_com, ip, params):
     # else:
     #     # Check if the new username is already taken
     #     if db_handle.change_username(old_username, new_username):
-    #         logged_in_users[ip] = new_username
+    #         presence.rename(old_username, new_username)
     #         com.send_data(Protocol.approve(params['opcode']), ip)
     #     else:
     #         com.send_data(Protocol.reject(params['opcode']), ip)
@@ -477,20 +501,20 @@ def handle_status_change(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    if ip in logged_in_users.keys():
-        db_handle = DBHandler('strife_db')
+    if presence.is_logged_in(ip):
+        db_handle = db_pool.get()
         new_status = str(params['new_status'])
 
         # Check new status
         if 0 < len(new_status) < 20:
-            db_handle.update_user_status(logged_in_users[ip], new_status)
-            msg = Protocol.user_status(logged_in_users[ip], new_status)
+            db_handle.update_user_status(presence.get_username(ip), new_status)
+            msg = Protocol.user_status(presence.get_username(ip), new_status)
             com.send_data(msg, ip)
         else:
             com.send_data(Protocol.reject(params['opcode']), ip)
@@ -509,22 +533,22 @@ def handle_password_change(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    if ip not in logged_in_users.keys():
+    if not presence.is_logged_in(ip):
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         new_password = params['new_password']
         old_password = params['old_password']
         hashed_old_password = hashlib.sha256(old_password.encode()).hexdigest()
 
         # Check if the old password is correct
-        if not db_handle.check_credentials(logged_in_users[ip], hashed_old_password):
+        if not db_handle.check_credentials(presence.get_username(ip), hashed_old_password):
             com.send_data(Protocol.reject(params['opcode']), ip)
             return
 
@@ -537,8 +561,8 @@ def handle_password_change(com, chat_com, files_com, ip, params):
             hashed_password = hashlib.sha256(new_password.encode()).hexdigest()
 
             # Change the password in the database and send the response
-            if db_handle.change_password(logged_in_users[ip], hashed_password):
-                logged_in_passwords[ip] = new_password
+            if db_handle.change_password(presence.get_username(ip), hashed_password):
+                presence.set_password(ip, new_password)
                 com.send_data(Protocol.approve(params['opcode']), ip)
             else:
                 com.send_data(Protocol.reject(params['opcode']), ip)
@@ -549,8 +573,8 @@ def handle_text_message(com, ip, params, raw):
     Handles a text message sent from a client in some chat
     :param com: The general communication object of the server
     :type com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :param raw: The raw message
@@ -558,24 +582,22 @@ def handle_text_message(com, ip, params, raw):
     :return: None
     """
     # Check if the user is logged in
-    if ip not in logged_in_users.keys():
+    if not presence.is_logged_in(ip):
         com.send_data(Protocol.reject(params['opcode']), ip)
 
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         chat_id = params['chat_id']
         sender = params['sender_username']
 
         # Encode the message to base64
         b64_raw = base64.b64encode(raw.encode()).decode()
         # Add the encoded message to the database
-        db_handle.add_message(chat_id, sender, b64_raw)
+        db_writer.submit('add_message', chat_id, sender, b64_raw)
         # Get the names of the members of the chat
         group_members_names = db_handle.get_group_members(chat_id)
         # Get the IPs of the members of the chat
-        connected_members_ips = [get_ip_by_username(member_name)
-                                 for member_name in group_members_names
-                                 if member_name in logged_in_users.values()]
+        connected_members_ips = presence.get_sessions_of(group_members_names)
 
         # Send the message to all the members of the chat
         com.send_data(raw, connected_members_ips)
@@ -586,8 +608,8 @@ def handle_file_description(com, ip, params, raw):
     Handles a file description sent from a client in some chat
     :param com: The general communication object of the server
     :type com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :param raw: The raw message
@@ -595,24 +617,22 @@ def handle_file_description(com, ip, params, raw):
     :return: None
     """
     # Check if the user is logged in
-    if ip not in logged_in_users.keys():
+    if not presence.is_logged_in(ip):
         com.send_data(Protocol.reject(params['opcode']), ip)
 
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         chat_id = params['chat_id']
         sender = params['sender']
 
         # Encode the message to base64
         b64_raw = base64.b64encode(raw.encode()).decode()
         # Add the encoded message to the database
-        db_handle.add_message(chat_id, sender, b64_raw)
+        db_writer.submit('add_message', chat_id, sender, b64_raw)
         # Get the names of the members of the chat
         group_members_names = db_handle.get_group_members(chat_id)
         # Get the IPs of the members of the chat
-        connected_members_ips = [get_ip_by_username(member_name)
-                                 for member_name in group_members_names
-                                 if member_name in logged_in_users.values()]
+        connected_members_ips = presence.get_sessions_of(group_members_names)
         # Send the message to all the members of the chat
         com.send_data(raw, connected_members_ips)
 
@@ -627,16 +647,16 @@ def handle_request_picture(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    if ip not in logged_in_users.keys():
+    if not presence.is_logged_in(ip):
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         username = str(params['pfp_username'])
         # Get the path of the profile picture
         pic_path = db_handle.get_user_picture_path(username)
@@ -656,29 +676,29 @@ def handle_update_pfp(com, ip, params):
     Function to handle a profile picture update
     :param com: The general communication object of the server
     :type com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    if ip not in logged_in_users.keys():
+    if not presence.is_logged_in(ip):
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         b64_picture = params['picture']
         # Decode the base64 picture
         pic_contents = base64.b64decode(b64_picture)
         # Save the picture and get the path
-        path = FileHandler.save_pfp(pic_contents, logged_in_users[ip])
+        path = FileHandler.save_pfp(pic_contents, presence.get_username(ip))
         # If the path is empty, the picture was not saved
         if not path:
             com.send_data(Protocol.reject(params['opcode']), ip)
         else:
             # Update the user's profile picture in the database
-            db_handle.update_user_picture(logged_in_users[ip], path)
+            db_handle.update_user_picture(presence.get_username(ip), path)
             # Send the profile picture to the client
-            msg = Protocol.profile_picture(logged_in_users[ip], b64_picture)
+            msg = Protocol.profile_picture(presence.get_username(ip), b64_picture)
             com.send_file(msg, ip)
 
 
@@ -692,23 +712,35 @@ def handle_chat_history_request(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    if ip not in logged_in_users.keys():
+    if not presence.is_logged_in(ip):
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         chat_id = params['chat_id']
-        # Get the chat's message history
-        history = db_handle.get_chat_history(chat_id)
-        # If the chat has a history, send it to the client
-        if history:
+        # Older clients don't send the paging params, and only get the newest page in the old format
+        paging = 'before_id' in params or 'limit' in params
+        # An empty param wasn't given (a paging client asks for the newest page without before_id)
+        before_id = params.get('before_id') if params.get('before_id') != '' else None
+        limit = params.get('limit') if params.get('limit') != '' else None
+        if (before_id is not None and type(before_id) != int) or (limit is not None and type(limit) != int):
+            com.send_data(Protocol.reject(params['opcode']), ip)
+            return
+
+        # Get a page of the chat's message history
+        history = db_handle.get_chat_history(chat_id, before_id, limit)
+        # If the chat has a history, send it to the client (an empty page tells a scrolling client it reached the end)
+        if history or before_id is not None:
+            history = history if history else []
             print(f'LOG: Sending chat history of chat {chat_id} to {ip}')
-            msg = Protocol.chat_history(history, chat_id)
+            # Only paging clients get the id to continue the history from
+            oldest_id = history[-1][0] if history and paging else None
+            msg = Protocol.chat_history([message for message_id, message in history], chat_id, oldest_id)
             print(f'LOG: History msg: {msg}')
             chat_com.send_data(msg, ip)
 
@@ -723,16 +755,16 @@ def handle_request_group_members(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    if ip not in logged_in_users.keys():
+    if not presence.is_logged_in(ip):
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         chat_id = params['chat_id']
         members = db_handle.get_group_members(chat_id)
         msg = Protocol.group_names(chat_id, members)
@@ -744,16 +776,15 @@ def handle_file_in_chat(com, ip, params):
     Function to handle a file in a chat
     :param com: The general communication object of the server
     :type com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    if ip not in logged_in_users.keys():
+    if not presence.is_logged_in(ip):
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
         chat_id = params['chat_id']
         filename = params['file_name']
         file_contents = params['file']
@@ -766,7 +797,213 @@ def handle_file_in_chat(com, ip, params):
             com.send_data(Protocol.reject(params['opcode']), ip)
         else:
             # Add the file to the database
-            db_handle.add_file(chat_id, filename, file_hash)
+            db_writer.submit('add_file', chat_id, filename, file_hash).result()
+
+
+def check_file_name(file_name):
+    """
+    Function to check if a name of an uploaded file is valid
+
+    :param file_name: The file name to check
+    :type file_name: str
+    :return: True if the file name is valid, False otherwise
+    :rtype: bool
+    """
+    is_valid = True
+
+    # Check if the file name is valid (it must stay inside the chat's folder)
+    if not file_name:
+        is_valid = False
+    elif file_name in ('.', '..'):
+        is_valid = False
+    elif '/' in file_name or '\\' in file_name:
+        is_valid = False
+
+    return is_valid
+
+
+def check_file_hash(file_hash):
+    """
+    Function to check if a hash of an uploaded file is a valid sha256 hex digest
+
+    :param file_hash: The file hash to check
+    :type file_hash: str
+    :return: True if the file hash is valid, False otherwise
+    :rtype: bool
+    """
+    return len(file_hash) == 64 and all(c in '0123456789abcdef' for c in file_hash)
+
+
+def handle_file_upload_start(com, ip, params):
+    """
+    Function to handle the start of a streamed file upload, the chunks of the file are received after it
+    :param com: The files communication object of the server
+    :type com: ServerCom
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
+    :param params: Dictionary of parameters of the message
+    :type params: dict
+    :return: None
+    """
+    start_upload(com, ip, params)
+
+
+def handle_file_upload_resume(com, ip, params):
+    """
+    Function to handle the start (or the continuation) of a resumable streamed file upload.
+    The server replies with the amount of bytes it already has, and the rest of the file's chunks are received after it
+    :param com: The files communication object of the server
+    :type com: ServerCom
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
+    :param params: Dictionary of parameters of the message
+    :type params: dict
+    :return: None
+    """
+    if not presence.is_logged_in(ip):
+        com.send_data(Protocol.reject(params['opcode']), ip)
+        return
+
+    file_hash = str(params.get('file_hash', ''))
+
+    # A resumable upload is identified by its hash
+    if not check_file_hash(file_hash):
+        com.send_data(Protocol.reject(params['opcode']), ip)
+    else:
+        start_upload(com, ip, params, file_hash)
+
+
+def start_upload(com, ip, params, file_hash=None):
+    """
+    Function to start a streamed file upload of a client
+    :param com: The files communication object of the server
+    :type com: ServerCom
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
+    :param params: Dictionary of parameters of the message
+    :type params: dict
+    :param file_hash: The hash of the file for a resumable upload, None otherwise
+    :type file_hash: str
+    :return: None
+    """
+    if not presence.is_logged_in(ip):
+        com.send_data(Protocol.reject(params['opcode']), ip)
+        return
+
+    chat_id = params.get('chat_id')
+    # A numeric file name is parsed as an int
+    filename = str(params['file_name']) if type(params.get('file_name')) in (str, int) else None
+    file_size = params.get('file_size')
+
+    # A new upload replaces an unfinished one
+    abort_upload(ip)
+
+    # Check the upload's params
+    if filename is None or not check_file_name(filename) \
+            or type(file_size) != int or not 0 <= file_size <= MAX_UPLOAD_SIZE:
+        com.send_data(Protocol.reject(params['opcode']), ip)
+        return
+
+    db_handle = db_pool.get()
+    try:
+        is_member = db_handle.is_in_group(chat_id, username=presence.get_username(ip))
+    except Exception:
+        is_member = False
+
+    # Check if the user can upload to the chat
+    if not is_member:
+        com.send_data(Protocol.reject(params['opcode']), ip)
+        return
+
+    # A resumable upload can't be continued by two clients at once
+    if file_hash and any(state['file_hash'] == file_hash and state['chat_id'] == chat_id
+                         for state in active_uploads.values()):
+        com.send_data(Protocol.reject(params['opcode']), ip)
+        return
+
+    try:
+        upload = FileHandler.start_upload(chat_id, filename, file_size, file_hash)
+    except Exception:
+        com.send_data(Protocol.reject(params['opcode']), ip)
+    else:
+        active_uploads[ip] = {'upload': upload, 'chat_id': chat_id, 'file_name': filename,
+                              'file_hash': file_hash, 'opcode': params['opcode']}
+        # Tell the client where to continue the upload from
+        if file_hash:
+            com.send_data(Protocol.upload_offset(chat_id, file_hash, upload.received), ip)
+        # An empty (or an already received) file is complete
+        if upload.is_complete():
+            finish_upload(com, ip)
+
+
+def handle_file_chunk(com, ip, chunk):
+    """
+    Function to handle a chunk of a streamed file upload
+    :param com: The files communication object of the server
+    :type com: ServerCom
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
+    :param chunk: The chunk's bytes
+    :type chunk: bytes
+    :return: None
+    """
+    # Check if the client started an upload
+    if ip not in active_uploads.keys():
+        return
+
+    state = active_uploads[ip]
+    try:
+        state['upload'].write(chunk)
+    except Exception:
+        abort_upload(ip, discard=True)
+        com.send_data(Protocol.reject(state['opcode']), ip)
+    else:
+        if state['upload'].is_complete():
+            finish_upload(com, ip)
+
+
+def finish_upload(com, ip):
+    """
+    Function to save a file whose streamed upload is complete
+    :param com: The files communication object of the server
+    :type com: ServerCom
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
+    :return: None
+    """
+    state = active_uploads.pop(ip)
+    try:
+        # Move the file to its place
+        file_hash = state['upload'].commit()
+    except Exception:
+        state['upload'].discard()
+        com.send_data(Protocol.reject(state['opcode']), ip)
+    else:
+        try:
+            # Add the file to the database
+            db_writer.submit('add_file', state['chat_id'], state['file_name'], file_hash).result()
+        except Exception:
+            com.send_data(Protocol.reject(state['opcode']), ip)
+        else:
+            com.send_data(Protocol.approve(state['opcode']), ip)
+
+
+def abort_upload(ip, discard=False):
+    """
+    Function to stop the unfinished streamed upload of a client.
+    The received bytes of a resumable upload are kept unless they are discarded
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
+    :param discard: Whether to delete the received bytes of a resumable upload
+    :type discard: bool
+    :return: None
+    """
+    state = active_uploads.pop(ip, None)
+    if state:
+        if discard:
+            state['upload'].discard()
+        else:
+            state['upload'].abort()
 
 
 def handle_request_file(com, chat_com, files_com, ip, params):
@@ -779,33 +1016,41 @@ def handle_request_file(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
 
-    # Check if the IP address is in the logged_in_users dictionary
-    if ip not in logged_in_users.keys():
+    # Check if the IP address is logged in
+    if not presence.is_logged_in(ip):
         # If the IP address is not logged in, send a rejection message to the client through the com object
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        # If the IP address is logged in, create a new DBHandler object with the 'strife_db' database
-        db_handle = DBHandler('strife_db')
+        # If the IP address is logged in, get the thread's database handler from the pool
+        db_handle = db_pool.get()
         # Get the file hash from the parameters dictionary
         file_hash = params['file_hash']
-        # Use the DBHandler object to get the file name and chat ID associated with the file hash
+        # Use the database handler to get the file name and chat ID associated with the file hash
         ret = db_handle.get_file(file_hash)
         if ret:
             file_name, chat_id = ret
             # Check if the client is a member of the group associated with the chat ID
-            if db_handle.is_in_group(chat_id, username=logged_in_users[ip]):
+            if not db_handle.is_in_group(chat_id, username=presence.get_username(ip)):
+                return
+
+            file_path = FileHandler.get_file_path(chat_id, file_name)
+            # Stream the file from the disk to clients that support it
+            if file_path and files_com.supports_streaming(ip):
+                msg = Protocol.file_download(chat_id, file_name, os.path.getsize(file_path), file_hash)
+                files_com.stream_file(msg, file_path, ip)
+            else:
                 # If the client is a member of the group, load the file contents and encode them in base64 format
                 file_contents = FileHandler.load_file(chat_id, file_name)
                 if not file_contents:
                     com.send_data(Protocol.reject(params['opcode']), ip)
-                    db_handle.remove_file(file_hash)
+                    db_writer.submit('remove_file', file_hash)
                 else:
                     # Create a message using the Protocol module's send_file() method
                     msg = Protocol.send_file(chat_id, file_name, file_contents.decode())
@@ -813,6 +1058,52 @@ def handle_request_file(com, chat_com, files_com, ip, params):
                     files_com.send_file(msg, ip)
 
 
+def handle_request_file_range(com, ip, params):
+    """
+    Function to handle a request for a byte range of a stored file, the range is streamed to the client
+    after a file_range message. A length of 0 requests the rest of the file
+
+    :param com: The files communication object of the server
+    :type com: ServerCom
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
+    :param params: Dictionary of parameters of the message
+    :type params: dict
+    :return: None
+    """
+    file_hash = str(params['file_hash'])
+    offset = params['offset']
+    length = params['length']
+
+    # Ranges are only streamed to clients that support chunk frames
+    if not presence.is_logged_in(ip) or not com.supports_streaming(ip):
+        com.send_data(Protocol.reject(params['opcode']), ip)
+        return
+
+    db_handle = db_pool.get()
+    ret = db_handle.get_file(file_hash)
+    file_path = None
+    if ret and type(offset) == int and type(length) == int:
+        file_name, chat_id = ret
+        # Check if the client is a member of the group associated with the chat ID
+        if db_handle.is_in_group(chat_id, username=presence.get_username(ip)):
+            file_path = FileHandler.get_file_path(chat_id, file_name)
+
+    if not file_path:
+        com.send_data(Protocol.reject(params['opcode']), ip)
+        return
+
+    file_size = os.path.getsize(file_path)
+    # Clamp the range to the file
+    offset = min(offset, file_size)
+    if length == 0 or offset + length > file_size:
+        length = file_size - offset
+
+    msg = Protocol.file_range(chat_id, file_name, file_size, file_hash, offset, length)
+    if not com.stream_file(msg, file_path, ip, offset, length):
+        com.send_data(Protocol.reject(params['opcode']), ip)
+
+
 def handle_request_status(com, chat_com, files_com, ip, params):
     """
     Function to handle a request for the status of a user
@@ -822,18 +1113,18 @@ def handle_request_status(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    # Check if the IP address is in the logged_in_users dictionary
-    if ip not in logged_in_users.keys():
+    # Check if the IP address is logged in
+    if not presence.is_logged_in(ip):
         # If the IP address is not logged in, send a rejection message to the client through the com object
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         username = params['username']
         # Get the status of the user from the database
         try:
@@ -841,7 +1132,7 @@ def handle_request_status(com, chat_com, files_com, ip, params):
         except Exception:
             com.send_data(Protocol.reject(params['opcode']), ip)
         else:
-            print(f"LOG: Sending status of {username} to {logged_in_users[ip]}")
+            print(f"LOG: Sending status of {username} to {presence.get_username(ip)}")
             com.send_data(Protocol.user_status(username, status), ip)
 
 
@@ -854,26 +1145,26 @@ def handle_voice_started(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    # Check if the IP address is in the logged_in_users dictionary
-    if ip not in logged_in_users.keys():
+    # Check if the IP address is logged in
+    if not presence.is_logged_in(ip):
         # If the IP address is not logged in, send a rejection message to the client through the com object
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         chat_id = params['chat_id']
         msg = Protocol.voice_started(chat_id)
         members = db_handle.get_group_members(chat_id)
-        print(f"LOG: Sending voice started message to {members} from {logged_in_users[ip]}")
+        print(f"LOG: Sending voice started message to {members} from {presence.get_username(ip)}")
         for member in members:
-            member_ip = get_ip_by_username(member)
-            if member_ip and member_ip != ip:
-                com.send_data(msg, member_ip)
+            for member_ip in presence.get_sessions(member):
+                if member_ip != ip:
+                    com.send_data(msg, member_ip)
 
 
 def handle_video_started(com, chat_com, files_com, ip, params):
@@ -885,28 +1176,28 @@ def handle_video_started(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    # Check if the IP address is in the logged_in_users dictionary
-    if ip not in logged_in_users.keys():
+    # Check if the IP address is logged in
+    if not presence.is_logged_in(ip):
         # If the IP address is not logged in, send a rejection message to the client through the com object
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         chat_id = params['chat_id']
         msg = Protocol.video_started(chat_id)
         # Get the members of the group associated with the chat ID
         members = db_handle.get_group_members(chat_id)
         # Send the message to all members of the group except the client that sent the message
-        print(f"LOG: Sending video started message to {members} from {logged_in_users[ip]}")
+        print(f"LOG: Sending video started message to {members} from {presence.get_username(ip)}")
         for member in members:
-            member_ip = get_ip_by_username(member)
-            if member_ip and member_ip != ip:
-                com.send_data(msg, member_ip)
+            for member_ip in presence.get_sessions(member):
+                if member_ip != ip:
+                    com.send_data(msg, member_ip)
 
 
 def handle_voice_join(com, chat_com, files_com, ip, params):
@@ -918,39 +1209,41 @@ def handle_voice_join(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    # Check if the IP address is in the logged_in_users dictionary
-    if ip not in logged_in_users.keys():
+    # Check if the IP address is logged in
+    if not presence.is_logged_in(ip):
         # If the IP address is not logged in, send a rejection message to the client through the com object
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         chat_id = params['chat_id']
         online_members_ips = []
         online_members_names = []
 
         # TODO: is it really necessary to send the voice user joined message
         #  to the client that sent the voice join message?
-        print(f"LOG: User {logged_in_users[ip]} joined voice call in chat {chat_id}")
-        msg = Protocol.voice_user_joined(chat_id, ip, logged_in_users[ip])
+        print(f"LOG: User {presence.get_username(ip)} joined voice call in chat {chat_id}")
+        # The clients connect to each other's ip (the session is the address of the general connection)
+        msg = Protocol.voice_user_joined(chat_id, ip[0], presence.get_username(ip))
         # Get the members of the group associated with the chat ID
         members = db_handle.get_group_members(chat_id)
         # Send the message to all members of the group except the client that sent the message
         for member in members:
-            member_ip = get_ip_by_username(member)
-            if member_ip and member_ip != ip:
-                com.send_data(msg, member_ip)
-                online_members_ips.append(member_ip)
-                online_members_names.append(member)
+            for member_ip in presence.get_sessions(member):
+                if member_ip != ip:
+                    com.send_data(msg, member_ip)
+                    online_members_ips.append(member_ip)
+                    online_members_names.append(member)
 
         if len(online_members_ips) > 0:
             # Send the voice call info message to the client that sent the voice join message
-            msg = Protocol.voice_call_info(chat_id, online_members_ips, online_members_names)
+            msg = Protocol.voice_call_info(chat_id, [member_ip[0] for member_ip in online_members_ips],
+                                           online_members_names)
             com.send_data(msg, ip)
 
 
@@ -963,36 +1256,38 @@ def handle_video_join(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    # Check if the IP address is in the logged_in_users dictionary
-    if ip not in logged_in_users.keys():
+    # Check if the IP address is logged in
+    if not presence.is_logged_in(ip):
         # If the IP address is not logged in, send a rejection message to the client through the com object
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         chat_id = params['chat_id']
         online_members_ips = []
         online_members_names = []
 
-        print(f"LOG: User {logged_in_users[ip]} joined video call in chat {chat_id}")
-        msg = Protocol.video_user_joined(chat_id, ip, logged_in_users[ip])
+        print(f"LOG: User {presence.get_username(ip)} joined video call in chat {chat_id}")
+        # The clients connect to each other's ip (the session is the address of the general connection)
+        msg = Protocol.video_user_joined(chat_id, ip[0], presence.get_username(ip))
         # Get the members of the group associated with the chat ID
         members = db_handle.get_group_members(chat_id)
         # Send the message to all members of the group except the client that sent the message
         for member in members:
-            member_ip = get_ip_by_username(member)
-            if member_ip and member_ip != ip:
-                com.send_data(msg, member_ip)
-                online_members_ips.append(member_ip)
-                online_members_names.append(member)
+            for member_ip in presence.get_sessions(member):
+                if member_ip != ip:
+                    com.send_data(msg, member_ip)
+                    online_members_ips.append(member_ip)
+                    online_members_names.append(member)
 
         if len(online_members_ips) > 0:
-            msg = Protocol.video_call_info(chat_id, online_members_ips, online_members_names)
+            msg = Protocol.video_call_info(chat_id, [member_ip[0] for member_ip in online_members_ips],
+                                           online_members_names)
             # Send the video call info message to the client that sent the video join message
             com.send_data(msg, ip)
 
@@ -1006,19 +1301,19 @@ def handle_request_friend_list(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    # Check if the IP address is in the logged_in_users dictionary
-    if ip not in logged_in_users.keys():
+    # Check if the IP address is logged in
+    if not presence.is_logged_in(ip):
         # If the IP address is not logged in, send a rejection message to the client through the com object
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
-        username = logged_in_users[ip]
+        db_handle = db_pool.get()
+        username = presence.get_username(ip)
         friend_list = db_handle.get_friends_of(username)
         # Check if the friend list is not empty
         if True:
@@ -1035,21 +1330,20 @@ def handle_logout(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    # Check if the IP address is in the logged_in_users dictionary
-    if ip not in logged_in_users.keys():
+    # Check if the IP address is logged in
+    if not presence.is_logged_in(ip):
         # If the IP address is not logged in, send a rejection message to the client through the com object
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        print(f'INFO: User logged out - "{logged_in_users[ip]}", {ip}')
-        # Remove the IP address from the logged_in_users dictionary
-        del logged_in_users[ip]
-        del logged_in_passwords[ip]
+        # Remove the session from the logged-in users
+        username = presence.logout(ip)
+        print(f'INFO: User logged out - "{username}", {ip}')
 
 
 def handle_request_keys(com, chat_com, files_com, ip, params):
@@ -1061,22 +1355,22 @@ def handle_request_keys(com, chat_com, files_com, ip, params):
     :type chat_com: ServerCom
     :param files_com: The files communication object of the server
     :type files_com: ServerCom
-    :param ip: IP address of the client
-    :type ip: str
+    :param ip: The session of the client (the (ip, port) address of its general connection)
+    :type ip: tuple
     :param params: Dictionary of parameters of the message
     :type params: dict
     :return: None
     """
-    # Check if the IP address is in the logged_in_users dictionary
-    if ip not in logged_in_users.keys():
+    # Check if the IP address is logged in
+    if not presence.is_logged_in(ip):
         # If the IP address is not logged in, send a rejection message to the client through the com object
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         # Get the keys of the user
-        username = logged_in_users[ip]
+        username = presence.get_username(ip)
         # Get the keys of the user and the chat IDs of the chats that the keys are associated with
-        keys, chat_ids = db_handle.get_user_keys(username, logged_in_passwords[ip])
+        keys, chat_ids = db_handle.get_user_keys(username, presence.get_password(ip))
         print(f'LOG: User requested keys - "{username}", {ip}', keys, chat_ids)
         # Check if the keys list is not empty
         if len(keys) > 0:
@@ -1086,10 +1380,10 @@ def handle_request_keys(com, chat_com, files_com, ip, params):
 
 
 def handle_request_picture_check(com, chat_com, files_com, ip, params):
-    if ip not in logged_in_users.keys():
+    if not presence.is_logged_in(ip):
         com.send_data(Protocol.reject(params['opcode']), ip)
     else:
-        db_handle = DBHandler('strife_db')
+        db_handle = db_pool.get()
         username = str(params['username'])
         user_current_hash = str(params['pfp_hash'])
         # Get the path of the profile picture
@@ -1113,7 +1407,8 @@ def handle_request_picture_check(com, chat_com, files_com, ip, params):
 
 def handle_general_messages(general_com, chat_com, files_com, q):
     """
-    Handle the general messages
+    Handle the general messages, the handlers run on the general dispatcher's workers
+    (the messages of every client are handled in the order they were received)
     :param chat_com: The chats communication object of the server
     :type chat_com: ServerCom
     :param general_com: The general communication object of the server
@@ -1124,11 +1419,9 @@ def handle_general_messages(general_com, chat_com, files_com, q):
     while True:
         data, ip = q.get()
 
-        # If a user has disconnected
+        # If a user has disconnected (after the user's earlier messages were handled)
         if data == '':
-            if ip in logged_in_users.keys():
-                del logged_in_users[ip]
-                del logged_in_passwords[ip]
+            general_dispatcher.submit(ip, 'disconnect', handle_disconnect, chat_com, files_com, ip)
 
         else:
             try:
@@ -1137,25 +1430,95 @@ def handle_general_messages(general_com, chat_com, files_com, q):
                 pass
             else:
                 if msg['opname'] in general_dict.keys():
-                    general_dict[msg['opname']](general_com, chat_com, files_com, ip, msg)
+                    general_dispatcher.submit(ip, msg['opname'], general_dict[msg['opname']],
+                                              general_com, chat_com, files_com, ip, msg)
 
 
 def handle_chats_messages(com, q):
     """
-    Handle the chats messages
+    Handle the chats messages, the handlers run on the chats dispatcher's shards
+    (the messages of every chat are handled in the order they were received)
     :param com: The chats communication object of the server
     :param q: The queue of messages
     :return: None
     """
     while True:
         data, ip = q.get()
+        # The client's chats connection is closed, its session continues on the general connection
+        if data == '':
+            continue
+
         try:
             msg = Protocol.unprotocol_msg("chats", data)
         except Exception as e:
             pass
         else:
-            if msg['opname'] in messages_dict.keys():
-                messages_dict[msg['opname']](com, ip, msg, data)
+            # Binding is done in order, before the connection's next messages
+            if msg['opname'] == 'bind_session':
+                handle_bind_session(com, ip, msg)
+            elif msg['opname'] in messages_dict.keys():
+                ip = resolve_session(com, ip)
+                chats_dispatcher.submit(msg.get('chat_id'), msg['opname'], messages_dict[msg['opname']],
+                                        com, ip, msg, data)
+
+
+def handle_disconnect(chat_com, files_com, ip):
+    """
+    Ends the session of a client whose general connection was closed
+    :param chat_com: The chats communication object of the server
+    :param files_com: The files communication object of the server
+    :param ip: The session of the client
+    :return: None
+    """
+    presence.logout(ip)
+    # Stop the session's streamed upload, it's done by the files thread that owns the uploads
+    # (the files connection's disconnect is reported with its own address once it's unbound)
+    files_com.message_queue.put(('', ip))
+    # The client's chats and files connections can be bound to its next session
+    chat_com.unbind_session(ip)
+    files_com.unbind_session(ip)
+
+
+def handle_bind_session(com, address, params):
+    """
+    Binds a client's chats or files connection to the session of the token it sent
+    :param com: The chats or files communication object of the server
+    :type com: ServerCom
+    :param address: The address of the client's connection (or the session it is bound to)
+    :param params: Dictionary of parameters of the message
+    :type params: dict
+    :return: None
+    """
+    session = presence.get_session_by_token(str(params.get('token')))
+    if session is not None and com.bind_session(address, session):
+        com.send_data(Protocol.approve(params['opcode']), session)
+    else:
+        com.send_data(Protocol.reject(params['opcode']), address)
+
+
+def resolve_session(com, address):
+    """
+    Returns the session of a client's chats or files connection.
+    A connection that isn't bound to a session is bound to a session from its ip that has no connection on the channel,
+    for clients that don't bind their connections with the session's token
+    :param com: The chats or files communication object of the server
+    :type com: ServerCom
+    :param address: The session or the (ip, port) address the message was reported with
+    :return: The session, or the address if the connection can't be bound
+    """
+    if presence.is_logged_in(address):
+        return address
+
+    # The connection might have been bound after the message was received
+    session = com.get_session(address)
+    if session is not None:
+        return session
+
+    for session in presence.get_sessions_at(address[0]):
+        if not com.is_connected(session) and com.bind_session(address, session):
+            return session
+
+    return address
 
 
 def handle_files_messages(com, q):
@@ -1167,13 +1530,73 @@ def handle_files_messages(com, q):
     """
     while True:
         data, ip = q.get()
+        ip = resolve_session(com, ip)
+
+        # The streamed uploads are handled in this thread, so a failing message must not stop it
+        try:
+            handle_files_message(com, ip, data)
+        except Exception as e:
+            print(f'ERROR: Handling a files message from {ip} failed -', e)
+            reject_files_message(com, ip, data)
+
+
+def handle_files_message(com, ip, data):
+    """
+    Handle a message of the files channel
+    :param com: The files communication object of the server
+    :param ip: The session of the client (or the address of its files connection if it isn't bound to one)
+    :param data: The message, the bytes of a chunk of a streamed upload, or '' if the client disconnected
+    :return: None
+    """
+    # A chunk of a streamed upload
+    if isinstance(data, bytes):
+        handle_file_chunk(com, ip, data)
+
+    # If a user has disconnected
+    elif data == '':
+        abort_upload(ip)
+
+    else:
         try:
             msg = Protocol.unprotocol_msg("files", data)
         except Exception:
             pass
         else:
-            if msg['opname'] in files_dict.keys():
-                threading.Thread(target=files_dict[msg['opname']], args=(com, ip, msg,)).start()
+            # Binding is done in order, before the connection's next messages
+            if msg['opname'] == 'bind_session':
+                handle_bind_session(com, ip, msg)
+            # Streamed uploads are handled in this thread so their chunks stay in order
+            elif msg['opname'] in files_stream_dict.keys():
+                files_stream_dict[msg['opname']](com, ip, msg)
+            elif msg['opname'] in files_dict.keys():
+                # The user's transfers share the per-user limit, even from a few sessions
+                user = presence.get_username(ip) or ip
+                if not transfer_scheduler.submit(user, len(data), msg['opname'], files_dict[msg['opname']],
+                                                 com, ip, msg):
+                    # Too many bytes are queued, the client can retry later
+                    com.send_data(Protocol.reject(msg['opcode']), ip)
+
+
+def reject_files_message(com, ip, data):
+    """
+    Rejects a message of the files channel whose handling failed, a failed chunk stops the client's upload
+    :param com: The files communication object of the server
+    :param ip: The session of the client (or the address of its files connection if it isn't bound to one)
+    :param data: The message, or the bytes of a chunk of a streamed upload
+    :return: None
+    """
+    try:
+        if isinstance(data, bytes):
+            state = active_uploads.get(ip)
+            abort_upload(ip)
+            opcode = state['opcode'] if state else None
+        else:
+            opcode = int(data.split(Protocol.FIELD_SEPARATOR)[0]) if data else None
+
+        if opcode is not None:
+            com.send_data(Protocol.reject(opcode), ip)
+    except Exception as e:
+        print(f'ERROR: Rejecting a files message from {ip} failed -', e)
 
 
 def send_pending_friend_requests(username, com):
@@ -1184,14 +1607,14 @@ def send_pending_friend_requests(username, com):
     :return: None
     """
     # Check if the user is logged in
-    if username in logged_in_users.values():
-        ip = get_ip_by_username(username)
-        pending_requests = [req_sender for req_sender, receiver in pending_friend_requests.items() if
-                            receiver == username]
+    ips = presence.get_sessions(username)
+    if ips:
+        with pending_lock:
+            pending_requests = [req_sender for req_sender, receiver in pending_friend_requests.items() if
+                                receiver == username]
         for request in pending_requests:
             msg = Protocol.friend_request_notify(request, silent=True)
-            if ip:
-                com.send_data(msg, ip)
+            com.send_data(msg, ips)
 
 
 def add_pending_message(message, username):
@@ -1201,13 +1624,14 @@ def add_pending_message(message, username):
     :param username: The username of the user to send the message to
     :return: None
     """
-    # Check if the user has pending messages
-    if username in pending_messages.keys():
-        # Add the message to the pending messages list
-        pending_messages[username].append(message)
-    else:
-        # Create a new list of pending messages for the user
-        pending_messages[username] = [message]
+    with pending_lock:
+        # Check if the user has pending messages
+        if username in pending_messages.keys():
+            # Add the message to the pending messages list
+            pending_messages[username].append(message)
+        else:
+            # Create a new list of pending messages for the user
+            pending_messages[username] = [message]
 
 
 def add_pending_key(key, chat_id, username):
@@ -1218,18 +1642,19 @@ def add_pending_key(key, chat_id, username):
     :param username: The username of the user to send the key to
     :return: None
     """
-    # Check if the user has pending keys
-    if username in pending_keys.keys():
-        # Check if the user has pending keys for the chat
-        if chat_id in pending_keys[username].keys():
-            # Add the key to the pending keys list
-            pending_keys[username][chat_id].append(key)
+    with pending_lock:
+        # Check if the user has pending keys
+        if username in pending_keys.keys():
+            # Check if the user has pending keys for the chat
+            if chat_id in pending_keys[username].keys():
+                # Add the key to the pending keys list
+                pending_keys[username][chat_id].append(key)
+            else:
+                # Create a new list of pending keys for the chat
+                pending_keys[username][chat_id] = [key]
         else:
-            # Create a new list of pending keys for the chat
-            pending_keys[username][chat_id] = [key]
-    else:
-        # Create a new dictionary of pending keys for the user
-        pending_keys[username] = {chat_id: [key]}
+            # Create a new dictionary of pending keys for the user
+            pending_keys[username] = {chat_id: [key]}
 
 
 def save_pending_keys(username, password):
@@ -1239,17 +1664,16 @@ def save_pending_keys(username, password):
     :param password: The password of the user
     :return: None
     """
-    # Check if the user has pending keys
-    if username in pending_keys.keys():
-        db_handle = DBHandler('strife_db')
-        # Get the pending keys of the user
-        pending = pending_keys[username]
+    # Take the pending keys of the user, keys that are queued from now on are taken by the next login
+    with pending_lock:
+        pending = pending_keys.pop(username, None)
+
+    # Check if the user had pending keys
+    if pending:
         # Add the pending keys to the keys list
         for chat_id in pending.keys():
             for key in pending[chat_id]:
-                db_handle.add_key(username, chat_id, key, password)
-
-        del pending_keys[username]
+                db_writer.submit('add_key', username, chat_id, key, password).result()
 
 
 def send_pending_messages(username, com):
@@ -1259,14 +1683,15 @@ def send_pending_messages(username, com):
     :param com: The general communication object of the server
     :return: None
     """
-    if username in logged_in_users.values():
-        ip = get_ip_by_username(username)
-        # Check if the user has pending messages
-        if username in pending_messages.keys():
-            # Send the pending messages to the user
-            messages = pending_messages[username]
-            for message in messages:
-                com.send_data(message, ip)
+    ips = presence.get_sessions(username)
+    if ips:
+        # Get the user's pending messages
+        with pending_lock:
+            messages = list(pending_messages.get(username, ()))
+
+        # Send the pending messages to the user
+        for message in messages:
+            com.send_data(message, ips)
 
 
 def send_group_members(com, chat_id):
@@ -1276,24 +1701,14 @@ def send_group_members(com, chat_id):
     :param chat_id: The chat id of the group
     :return: None
     """
-    db_handle = DBHandler('strife_db')
+    db_handle = db_pool.get()
     # Get the group members
     members = db_handle.get_group_members(chat_id)
     msg = Protocol.group_names(chat_id, members)
     # Send the group members to all the online group members
-    for member in members:
-        member_ip = get_ip_by_username(member)
-        if member_ip:
-            com.send_data(msg, member_ip)
-
-
-def get_ip_by_username(username):
-    """
-    Get the ip of a user by his username
-    :param username: The username of the user
-    :return: The ip of the user, or None if not found
-    """
-    return next((target_ip for target_ip, name in logged_in_users.items() if name == username), None)
+    member_ips = presence.get_sessions_of(members)
+    if member_ips:
+        com.send_data(msg, member_ips)
 
 
 # The dictionary of the general messages
@@ -1334,14 +1749,53 @@ messages_dict = {
 # The dictionary of the files messages
 files_dict = {
     'profile_pic_change': handle_update_pfp,
-    'file_in_chat': handle_file_in_chat
+    'file_in_chat': handle_file_in_chat,
+    'request_file_range': handle_request_file_range
 }
 
-# The dictionary of the users with the key being the ip and the value being the username
-logged_in_users = {}
+# The dictionary of the files messages that are handled in order with the chunks of streamed uploads
+files_stream_dict = {
+    'file_upload_start': handle_file_upload_start,
+    'file_upload_resume': handle_file_upload_resume
+}
+
+# The dictionary of the streamed uploads with the key being the ip and the value being the upload's state
+active_uploads = {}
+
+# The amount of worker threads that handle the general messages
+GENERAL_WORKERS = max(4, os.cpu_count() or 1)
 
-# The dictionary of the users with the key being the username and the value being the password
-logged_in_passwords = {}
+# The amount of shards (worker threads) that handle the chats messages
+CHATS_SHARDS = max(4, os.cpu_count() or 1)
+
+# The amount of worker threads that handle the files messages
+TRANSFER_WORKERS = 4
+
+# The amount of database connections that aren't held by a worker thread
+DB_POOL_HEADROOM = 4
+
+# The pool of the database handlers, every handler thread borrows one connection for its lifetime,
+# so there is a connection for every worker and for the files messages thread
+db_pool = DBPool('strife_db', max_size=GENERAL_WORKERS + CHATS_SHARDS + TRANSFER_WORKERS + 1 + DB_POOL_HEADROOM)
+
+# The thread that commits the messages, keys and files that are added to the database in batches
+db_writer = DBWriter('strife_db', log=True)
+
+# The worker threads that handle the general messages
+general_dispatcher = OrderedDispatcher('general', workers=GENERAL_WORKERS, log=True)
+
+# The shards that handle the chats messages, every chat is handled by one of them
+chats_dispatcher = ShardedDispatcher('chats', shards=CHATS_SHARDS, log=True)
+
+# The worker threads that handle the files messages, with a budget of the bytes that are handled at once
+transfer_scheduler = TransferScheduler('files', workers=TRANSFER_WORKERS, byte_budget=64 * 1024 * 1024,
+                                       max_queued_bytes=256 * 1024 * 1024, user_limit=2, log=True)
+
+# The max size of a streamed upload (in bytes)
+MAX_UPLOAD_SIZE = 512 * 1024 * 1024
+
+# The registry of the logged-in users and their sessions (the (ip, port) addresses of their general connections)
+presence = PresenceRegistry()
 
 # The dictionary of the pending friend requests with the key being the sender and the value being the receiver
 pending_friend_requests = {}
@@ -1351,27 +1805,45 @@ pending_messages = {}
 
 pending_keys = {}
 
+# Guards the pending friend requests, messages and keys, the general messages are handled by a few workers at once.
+# Reentrant, since the pending messages and keys are added while it's held
+pending_lock = threading.RLock()
+
+# The path of the server's RSA keypair (relative to the project folder)
+SERVER_KEY_PATH = 'data/server_key.pem'
+
 
 def main():
     script_path = Path(os.path.abspath(__file__))
     wd = script_path.parent.parent.parent
     os.chdir(str(wd))
     FileHandler.initialize()
+    # Create the database's schema once, before the handlers use the database
+    db_pool.initialize()
+    db_writer.start()
+    general_dispatcher.start()
+    chats_dispatcher.start()
+    transfer_scheduler.start()
+
+    # Load the server's RSA keypair (it is only generated on the first run), all the channels share it
+    rsa = RSACipher.from_key_file(SERVER_KEY_PATH)
 
     # Create the general messages queue
     general_queue = queue.Queue()
     # Create the communication object for the general messages
-    general_com = ServerCom(3108, general_queue, log=True)
+    general_com = ServerCom(3108, general_queue, log=True, rsa=rsa)
 
     # Create the chat messages queue
     chats_queue = queue.Queue()
     # Create the communication object for the chat messages
-    chats_com = ServerCom(2907, chats_queue, com_type='chats')
+    chats_com = ServerCom(2907, chats_queue, com_type='chats', rsa=rsa)
 
     # Create the files messages queue
     files_queue = queue.Queue()
     # Create the communication object for the files messages
-    files_com = ServerCom(3103, files_queue, com_type='files')
+    # (files are big, so more output can wait for a client before it counts as a slow consumer)
+    files_com = ServerCom(3103, files_queue, com_type='files',
+                          high_watermark=64 * 1024 * 1024, low_watermark=16 * 1024 * 1024, rsa=rsa)
 
     # Start a thread to handle the general messages being received
     threading.Thread(target=handle_general_messages, args=(general_com, chats_com, files_com, general_queue)).start()
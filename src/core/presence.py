@@ -0,0 +1,195 @@
+import secrets
+import threading
+
+
+class PresenceRegistry:
+    """
+    A thread-safe registry of the logged-in users.
+    A session is the (ip, port) address of a logged-in client's general connection, so clients behind the same ip
+    are different sessions, and a user can be logged in from a few sessions at once.
+    Sessions and usernames are mapped both ways, so every lookup is a dict lookup.
+    Every session gets a random token, the client binds its chats and files connections to the session with it.
+    """
+
+    MAX_SESSIONS = 5  # The max amount of sessions of one user
+
+    def __init__(self, max_sessions=MAX_SESSIONS):
+        """
+        Creates an empty registry
+        :param max_sessions: The max amount of sessions of one user
+        """
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.usernames = {}  # The usernames with the key being the session
+        self.sessions = {}  # The sessions of every user (as dict keys, in the order they logged in)
+        self.passwords = {}  # The passwords with the key being the username
+        self.by_ip = {}  # The sessions from every ip (as dict keys, in the order they logged in)
+        self.tokens = {}  # The sessions with the key being the session's token
+        self.session_tokens = {}  # The tokens with the key being the session
+
+    def login(self, session, username: str, password: str) -> bool:
+        """
+        Adds a session of a user
+        :param session: The session (the address of the client's general connection)
+        :param username: The user's username
+        :param password: The user's password
+        :return: True if the session was added, False if the session is already logged in
+        or the user has too many sessions
+        """
+        with self.lock:
+            if session in self.usernames:
+                return False
+
+            sessions = self.sessions.setdefault(username, {})
+            if len(sessions) >= self.max_sessions:
+                return False
+
+            sessions[session] = None
+            self.usernames[session] = username
+            self.passwords[username] = password
+            self.by_ip.setdefault(session[0], {})[session] = None
+
+            token = secrets.token_urlsafe(16)
+            self.tokens[token] = session
+            self.session_tokens[session] = token
+            return True
+
+    def logout(self, session):
+        """
+        Removes a session (on logout or disconnect)
+        :param session: The session
+        :return: The username of the session, or None if it wasn't logged in
+        """
+        with self.lock:
+            username = self.usernames.pop(session, None)
+            if username is not None:
+                sessions = self.sessions[username]
+                sessions.pop(session, None)
+                # The user's last session
+                if not sessions:
+                    del self.sessions[username]
+                    del self.passwords[username]
+
+                ip_sessions = self.by_ip[session[0]]
+                del ip_sessions[session]
+                if not ip_sessions:
+                    del self.by_ip[session[0]]
+
+                del self.tokens[self.session_tokens.pop(session)]
+            return username
+
+    def is_logged_in(self, session) -> bool:
+        """
+        Checks if a session is logged in
+        :param session: The session
+        """
+        return session in self.usernames
+
+    def is_online(self, username: str) -> bool:
+        """
+        Checks if a user has a session
+        :param username: The user's username
+        """
+        return username in self.sessions
+
+    def get_username(self, session):
+        """
+        Returns the username of a session
+        :param session: The session
+        :return: The username, or None if the session isn't logged in
+        """
+        return self.usernames.get(session)
+
+    def get_sessions(self, username: str) -> list:
+        """
+        Returns the sessions of a user
+        :param username: The user's username
+        :return: A list of the user's sessions (empty if the user is offline)
+        """
+        with self.lock:
+            return list(self.sessions.get(username, ()))
+
+    def get_sessions_of(self, usernames) -> list:
+        """
+        Returns the sessions of a few users
+        :param usernames: The users' usernames
+        :return: A list of the sessions of all the users that are online
+        """
+        with self.lock:
+            return [session for username in usernames for session in self.sessions.get(username, ())]
+
+    def get_sessions_at(self, ip: str) -> list:
+        """
+        Returns the sessions that logged in from an ip
+        :param ip: The ip
+        :return: A list of the sessions, in the order they logged in
+        """
+        with self.lock:
+            return list(self.by_ip.get(ip, ()))
+
+    def get_token(self, session):
+        """
+        Returns the token of a session
+        :param session: The session
+        :return: The token, or None if the session isn't logged in
+        """
+        return self.session_tokens.get(session)
+
+    def get_session_by_token(self, token: str):
+        """
+        Returns the session of a token
+        :param token: The token
+        :return: The session, or None if no logged-in session has the token
+        """
+        return self.tokens.get(token)
+
+    def get_password(self, session):
+        """
+        Returns the password of the user of a session
+        :param session: The session
+        :return: The password, or None if the session isn't logged in
+        """
+        with self.lock:
+            return self.passwords.get(self.usernames.get(session))
+
+    def get_user_password(self, username: str):
+        """
+        Returns the password of an online user
+        :param username: The user's username
+        :return: The password, or None if the user is offline
+        """
+        return self.passwords.get(username)
+
+    def set_password(self, session, password: str):
+        """
+        Changes the password of the user of a session (for all the user's sessions)
+        :param session: The session
+        :param password: The new password
+        :return: -
+        """
+        with self.lock:
+            username = self.usernames.get(session)
+            if username is not None:
+                self.passwords[username] = password
+
+    def rename(self, username: str, new_username: str):
+        """
+        Changes the username of all the sessions of a user
+        :param username: The user's username
+        :param new_username: The user's new username
+        :return: -
+        """
+        with self.lock:
+            sessions = self.sessions.pop(username, None)
+            if sessions is not None:
+                self.sessions[new_username] = sessions
+                self.passwords[new_username] = self.passwords.pop(username)
+                for session in sessions:
+                    self.usernames[session] = new_username
+
+    def stats(self) -> dict:
+        """
+        Returns the amount of online users and sessions
+        """
+        with self.lock:
+            return {'users': len(self.sessions), 'sessions': len(self.usernames)}
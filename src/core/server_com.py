@@ -1,8 +1,15 @@
+import errno
 import socket
-import select
+import selectors
 import queue
 import threading
+import collections
+import concurrent.futures
 from src.core.cryptions import RSACipher, AESCipher
+from src.core.connection import ClientConnection
+from src.core.file_transfer import FileTransfer
+from src.core.framing import FrameDecoder, BinaryFrameDecoder, MAGIC, HELLO_FORMAT, LEGACY_VERSION, VERSION_2, \
+    CAP_AES_GCM, FRAME_FLAG_CHUNK
 
 
 class ServerCom:
@@ -10,22 +17,63 @@ class ServerCom:
     Class that handles the communication between the server and the clients.
     """
 
-    def __init__(self, server_port: int, message_queue: queue.Queue, com_type: str = 'general', log=False):
+    def __init__(self, server_port: int, message_queue: queue.Queue, com_type: str = 'general', log=False,
+                 high_watermark: int = 1024 * 1024, low_watermark: int = 256 * 1024,
+                 slow_consumer_policy: str = 'disconnect', handshake_workers: int = 8,
+                 handshake_queue_limit: int = 256, handshake_timeout: float = 10, rsa: RSACipher = None):
         """
         Creates a server object for communicating with clients
         :param server_port: The server port
         :param message_queue: The message queue
+        :param high_watermark: The amount of queued output (in bytes) that marks a client as a slow consumer
+        :param low_watermark: The amount of queued output (in bytes) a slow consumer has to drain to before
+        messages are queued to it again
+        :param slow_consumer_policy: What to do with messages to a slow consumer - 'drop' them or 'disconnect' it
+        :param handshake_workers: The amount of threads that swap keys with new clients
+        :param handshake_queue_limit: The amount of new clients that can wait for a free handshake thread,
+        clients that connect when the queue is full are rejected
+        :param handshake_timeout: The max time (in seconds) to wait for a client on every step of the key swap
+        :param rsa: The server's RSA object, can be shared between the communication objects.
+        A new keypair is generated if it isn't given
         """
         self.MAX_SIZE = 16 * 1000000
         self.FILE_CHUNK_SIZE = 4096  # The chunk size to send when sending files
+        self.RECV_SIZE = 64 * 1024  # The max amount of bytes to receive from a client at once
+        self.TRANSFER_CHUNK_SIZE = 256 * 1024  # The size of the chunks of a streamed file
+        self.TRANSFER_WINDOW = 1024 * 1024  # The amount of output the loop keeps queued for a client streaming a file
+        self.ACCEPT_BACKOFF = 0.5  # The time to stop accepting clients when the server is out of file descriptors
+        self.HEADER_SIZE = 10 if com_type == 'files' else 4  # The length of the size header of a legacy message
+        self.SUPPORTED_FLAGS = CAP_AES_GCM  # The capability flags the server can negotiate with v2 clients
         self.port = server_port  # The server's port
         self.message_queue = message_queue  # The message queue of the server
         self.socket = None  # The socket of the server
-        self.open_clients = {}  # [soc]:[ip, key]
-        self.rsa = RSACipher()  # The RSA encryption and decryption object
+        self.open_clients = {}  # [soc]:ClientConnection
+        self.clients_by_addr = {}  # [(ip, port)]:ClientConnection
+        self.clients_by_ip = {}  # [ip]:{[(ip, port)]:ClientConnection}, in the order the clients connected
+        self.clients_by_session = {}  # [session]:ClientConnection, for the connections that were bound to a session
+        self._clients_lock = threading.Lock()  # Guards the address indexes
+        self.rsa = rsa if rsa else RSACipher()  # The RSA encryption and decryption object
         self.com_type = com_type
         self.clients_keys = {}
         self.log = log
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_consumer_policy = slow_consumer_policy
+        self.handshake_timeout = handshake_timeout
+        self.handshake_limit = handshake_workers + handshake_queue_limit  # Max handshakes running or waiting
+        # The pool of threads that swap keys with new clients
+        self._handshake_pool = concurrent.futures.ThreadPoolExecutor(max_workers=handshake_workers,
+                                                                     thread_name_prefix=f'{com_type}-handshake')
+        self._handshake_lock = threading.Lock()  # Guards the handshake counters
+        self.handshakes_in_flight = 0  # The amount of handshakes that are running or waiting for a thread
+        self.handshakes_rejected = 0  # The amount of clients that were rejected because the pool was full
+        self.selector = selectors.DefaultSelector()  # The event loop's selector (epoll on linux)
+        self._loop_thread_id = None  # The id of the thread that runs the event loop
+        self._pending_calls = collections.deque()  # Callbacks that other threads scheduled on the event loop
+        # A pair of connected sockets used by other threads to wake the event loop up
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+        self._wakeup_receiver.setblocking(False)
+        self._wakeup_sender.setblocking(False)
 
         # Start the main loop in a thread
         threading.Thread(target=self._main).start()
@@ -38,79 +86,254 @@ class ServerCom:
         # Create the socket
         self.socket = socket.socket()
         self.socket.bind(('0.0.0.0', self.port))
-        self.socket.listen(4)
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
+
+        # Register the listening socket and the wakeup socket once, they stay registered for the server's lifetime
+        self._loop_thread_id = threading.get_ident()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.selector.register(self._wakeup_receiver, selectors.EVENT_READ)
 
         while True:
-            rlist, wlist, xlist = select.select([self.socket] + list(self.open_clients.keys()),
-                                                list(self.open_clients.keys()), [], 0.03)
-            for current_socket in rlist:
+            # Block until a socket is ready or another thread wakes the loop up
+            events = self.selector.select()
+            for key, mask in events:
+                current_socket = key.fileobj
                 if current_socket is self.socket:
-                    # Connecting a new client
-                    client, addr = self.socket.accept()
-                    ip = addr[0]
-                    # Start a thread to swap keys with the client
-                    threading.Thread(target=self._change_keys, args=(client, addr[0],)).start()
+                    # Connecting new clients
+                    self._accept_clients()
+
+                elif current_socket is self._wakeup_receiver:
+                    # Another thread has scheduled work for the loop
+                    self._clear_wakeup()
+
+                else:
+                    # The client can receive more of its pending output
+                    if mask & selectors.EVENT_WRITE and current_socket in self.open_clients.keys():
+                        self._send_pending(self.open_clients[current_socket])
+
+                    # A message has been sent from a client
+                    if mask & selectors.EVENT_READ and current_socket in self.open_clients.keys():
+                        self._receive_message(current_socket)
+
+            # Run the work that was scheduled by other threads
+            self._run_pending_calls()
+
+    def _accept_clients(self):
+        """
+        Accepts all the clients that are waiting in the listening socket's backlog
+        :return: -
+        """
+        while True:
+            try:
+                client, addr = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                # No more clients are waiting
+                break
+            except socket.error as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    # The waiting clients keep the listening socket readable, so stop watching it for a while
+                    # instead of waking up for it again and again
+                    if self.log:
+                        print(f'{self.com_type.upper()}: Can\'t accept clients -', e)
+                    self._pause_accepting()
+                break
+
+            with self._handshake_lock:
+                is_full = self.handshakes_in_flight >= self.handshake_limit
+                if is_full:
+                    self.handshakes_rejected += 1
+                else:
+                    self.handshakes_in_flight += 1
+
+            # Too many clients are waiting for a key swap, the client can try to connect again later
+            if is_full:
+                if self.log:
+                    print(f'{self.com_type.upper()}: Connection attempt by-', addr[0], 'was rejected')
+                client.close()
+                continue
+
+            # The key swap is done with blocking calls that time out
+            client.settimeout(self.handshake_timeout)
+            # Swap keys with the client in the handshake pool
+            self._handshake_pool.submit(self._handshake, client, addr)
+
+    def _pause_accepting(self):
+        """
+        Stops accepting clients for ACCEPT_BACKOFF seconds (when the server is out of file descriptors)
+        :return: -
+        """
+        self.selector.unregister(self.socket)
+        # The timer's thread asks the event loop to watch the listening socket again
+        timer = threading.Timer(self.ACCEPT_BACKOFF, self._call_soon, args=(self._resume_accepting,))
+        timer.daemon = True
+        timer.start()
+
+    def _resume_accepting(self):
+        """
+        Starts accepting clients again after a pause
+        :return: -
+        """
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        # Accept the clients that waited during the pause
+        self._accept_clients()
+
+    def _handshake(self, client: socket.socket, addr: tuple):
+        """
+        Swaps keys with a client in a thread of the handshake pool
+        :param client: The client socket
+        :param addr: The client's address (ip, port)
+        :return: -
+        """
+        try:
+            self._change_keys(client, addr)
+        finally:
+            with self._handshake_lock:
+                self.handshakes_in_flight -= 1
 
-                # A message has been sent from a client
+    def _receive_message(self, current_socket: socket.socket):
+        """
+        Receives the bytes a client sent and puts every completed message in the message queue.
+        Messages are put as strings, except for file chunks which are put as bytes
+        :param current_socket: The client socket
+        :return: -
+        """
+        connection = self.open_clients[current_socket]
+        try:
+            # The socket is readable so a single recv never blocks the loop
+            data = current_socket.recv(self.RECV_SIZE)
+        except socket.error:
+            self._close_client(current_socket)
+            return
+
+        if not data:
+            # Client disconnected
+            self._close_client(current_socket)
+            return
+
+        try:
+            # Decode every frame that was completed by the received bytes
+            frames = connection.decoder.feed(data)
+        except ValueError:
+            # The client broke the protocol
+            self._close_client(current_socket)
+            return
+
+        for flags, frame in frames:
+            try:
+                # Decrypt the data and decode it back to a string
+                if flags & FRAME_FLAG_CHUNK:
+                    # File chunks are passed on as raw bytes
+                    dec_data = connection.cipher.decrypt(frame)
+                elif connection.version == VERSION_2:
+                    dec_data = connection.cipher.decrypt(frame).decode()
                 else:
-                    size = None
-                    try:
-                        if self.com_type == 'files':
-                            size = current_socket.recv(10).decode()
-                        else:
-                            # Receive the size of the data
-                            size = current_socket.recv(4).decode()
-
-                        # Convert the size to int
-                        size = int(size)
-
-                        if size > self.MAX_SIZE:
-                            continue
-                        # Receive the data
-                        if size > 1024:
-                            data = self.receive_file(size, current_socket)
-                        else:
-                            data = current_socket.recv(size)
-
-                    # Handle exceptions
-                    except ValueError:
-                        self._close_client(current_socket)
-                    except socket.error as e:
-                        self._close_client(current_socket)
-
-                    else:
-                        if data == '':
-                            # Client disconnected
-                            self._close_client(current_socket)
-                        else:
-                            try:
-                                # Decrypt the data and decode it back to a string
-                                dec_data = AESCipher.decrypt(self.open_clients[current_socket][1], data.decode())
-                            except Exception:
-                                self._close_client(current_socket)
-                            else:
-                                # Add the message to the queue
-                                self.message_queue.put((dec_data, self.open_clients[current_socket][0]))
-
-    def _change_keys(self, client: socket.socket, ip: str):
+                    dec_data = AESCipher.decrypt(connection.cipher, frame.decode())
+            except Exception:
+                self._close_client(current_socket)
+                break
+            else:
+                # Add the message to the queue, with the client's session (or address if it isn't bound to one)
+                self.message_queue.put((dec_data, connection.session or connection.addr))
+
+    def _in_loop_thread(self) -> bool:
+        """
+        Checks if the current thread is the thread of the event loop
+        :return: True if called from the event loop's thread
+        """
+        return threading.get_ident() == self._loop_thread_id
+
+    def _call_soon(self, callback, *args):
+        """
+        Schedules a callback to run on the event loop's thread, the selector is only touched by that thread
+        :param callback: The function to call
+        :param args: The arguments of the function
+        :return: -
+        """
+        self._pending_calls.append((callback, args))
+        self._wakeup()
+
+    def _run_pending_calls(self):
+        """
+        Runs the callbacks that were scheduled by other threads
+        :return: -
+        """
+        while self._pending_calls:
+            callback, args = self._pending_calls.popleft()
+            callback(*args)
+
+    def _wakeup(self):
+        """
+        Wakes the event loop up from a blocking select
+        :return: -
+        """
+        try:
+            self._wakeup_sender.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # The wakeup socket's buffer is full, so the loop is going to wake up anyway
+            pass
+
+    def _clear_wakeup(self):
+        """
+        Empties the wakeup socket after the loop was woken up
+        :return: -
+        """
+        try:
+            while self._wakeup_receiver.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _register_client(self, client: socket.socket):
+        """
+        Registers a client that finished the key swap in the event loop
+        :param client: The client socket
+        :return: -
+        """
+        # The client might have been closed while it was waiting to be registered
+        if client in self.open_clients.keys():
+            # From now on the socket is only used by the event loop
+            client.setblocking(False)
+            connection = self.open_clients[client]
+            with connection.lock:
+                # Messages might have been queued before the client was registered
+                events = selectors.EVENT_READ | selectors.EVENT_WRITE if connection.writing else selectors.EVENT_READ
+            self.selector.register(client, events)
+
+    def _change_keys(self, client: socket.socket, addr: tuple):
         """
         Swaps public keys with a client and adds him to the open clients
         :param client: The client socket
-        :param ip: The client's ip
+        :param addr: The client's address (ip, port)
         :return: -
         """
+        ip = addr[0]
         try:
             # Get the server's public key in a string
             key = self.rsa.get_string_public_key()
             # Send the server's public key to the client
             client.send(key.encode())
-            # Receive the client's public key and decode it into a string
-            client_key = client.recv(1024).decode()
-            # Convert the client's key from a string to a publicKey object
-            client_rsa_key = client_key
+            # Receive the client's public key
+            client_key = client.recv(1024)
+
+            # Clients that support protocol v2 send a hello before their public key
+            version, flags = LEGACY_VERSION, 0
+            if client_key.startswith(MAGIC):
+                magic, client_version, client_flags = HELLO_FORMAT.unpack_from(client_key)
+                # The public key might arrive after the hello
+                client_key = client_key[HELLO_FORMAT.size:] or client.recv(1024)
+                version = VERSION_2 if client_version >= VERSION_2 else LEGACY_VERSION
+                # Capabilities are only negotiated with v2 clients, legacy framing always uses AES-CBC
+                flags = client_flags & self.SUPPORTED_FLAGS if version == VERSION_2 else 0
+
+            # Convert the client's key from bytes to a string
+            client_rsa_key = client_key.decode()
             # Create a new aes key with the client
             aes_key = AESCipher.generate_key()
             enc_aes_key = self.rsa.encrypt(aes_key, client_rsa_key)
+            # Answer the hello with the version and flags the client should use
+            if version == VERSION_2:
+                client.sendall(HELLO_FORMAT.pack(MAGIC, version, flags))
             # Send the key to the client
             client.send(enc_aes_key)
 
@@ -122,110 +345,353 @@ class ServerCom:
 
         else:
             # Add the client to the dict of connected clients and save his ip and public key
-            self.open_clients[client] = [ip, aes_key]
+            if version == VERSION_2:
+                decoder = BinaryFrameDecoder(self.MAX_SIZE)
+            else:
+                decoder = FrameDecoder(self.HEADER_SIZE, self.MAX_SIZE)
+            connection = ClientConnection(client, addr, aes_key, decoder, version, flags)
+            with self._clients_lock:
+                self.open_clients[client] = connection
+                self.clients_by_addr[addr] = connection
+                self.clients_by_ip.setdefault(ip, {})[addr] = connection
+            # Start listening to the client's messages in the event loop
+            self._call_soon(self._register_client, client)
             if self.log:
                 print(f'{self.com_type.upper()}: New client connected-', ip)
 
-    def receive_file(self, size: int, client_socket: socket.socket):
+    def _get_connection(self, address):
         """
-        Receive a file from a client
-        :param client_socket: The client socket
-        :param size: The size of the file
-        :return: The file (as bytes)
+        Find the connection of a client in the server's connected clients
+        :param address: The session the client's connection was bound to, its (ip, port) address,
+        or its ip (the first client that connected from it is returned)
+        :return: The connection of the client, or None if it isn't connected
         """
-        # Initialize an empty bytearray to store the file data
-        file_data = bytearray()
+        with self._clients_lock:
+            if type(address) == tuple:
+                connection = self.clients_by_session.get(address)
+                return connection if connection else self.clients_by_addr.get(address)
 
-        # Keep receiving data until the entire file has been received
-        while len(file_data) < size:
-            try:
-                chunk = client_socket.recv(self.FILE_CHUNK_SIZE)
-            # Handle exceptions
-            except socket.error:
-                file_data = None
-                self._close_client(client_socket)
-                break
-            else:
-                if not chunk:
-                    break
-                file_data += chunk
+            connections = self.clients_by_ip.get(address)
+            return next(iter(connections.values())) if connections else None
 
-        return file_data
+    def bind_session(self, address: tuple, session: tuple) -> bool:
+        """
+        Binds a client's connection to a session, from now on the client's messages are reported with the session
+        and messages to the session are sent to the client
+        :param address: The client's (ip, port) address (or the session it is bound to)
+        :param session: The session (the (ip, port) address of the client's general connection)
+        :return: True if the connection was bound, False if the client isn't connected
+        """
+        with self._clients_lock:
+            connection = self.clients_by_session.get(address) or self.clients_by_addr.get(address)
+            if connection is None:
+                return False
+
+            self._bind(connection, session)
+            return True
 
-    def _get_sock_by_ip(self, target_ip: str):
+    def bind_first_unbound(self, ip: str, session: tuple) -> bool:
         """
-        Find the socket that belongs to the target ip in the server's connected clients dict
-        :param target_ip: The ip of the socket
-        :return: The socket of the client
+        Binds the first client from an ip that isn't bound to a session yet (for clients that don't bind themselves)
+        :param ip: The client's ip
+        :param session: The session (the (ip, port) address of the client's general connection)
+        :return: True if the session is bound to a connection
         """
-        # Return value
-        ret_sock = None
+        with self._clients_lock:
+            if session in self.clients_by_session:
+                return True
 
-        # Loop over all the clients connected to the server
-        for soc, (ip, key) in self.open_clients.items():
-            # Check if the ip is the target ip
-            if ip == target_ip:
-                # Return the socket found
-                ret_sock = soc
-                break
+            for connection in self.clients_by_ip.get(ip, {}).values():
+                if connection.session is None:
+                    self._bind(connection, session)
+                    return True
 
-        return ret_sock
+            return False
 
-    def send_data(self, data, dst_addr):
+    def unbind_session(self, session: tuple):
+        """
+        Unbinds a session from its connection (when the session ended), the connection can be bound again
+        :param session: The session
+        :return: -
+        """
+        with self._clients_lock:
+            connection = self.clients_by_session.pop(session, None)
+            if connection is not None:
+                connection.session = None
+
+    def get_session(self, address: tuple):
+        """
+        Returns the session a client's connection is bound to
+        :param address: The client's (ip, port) address
+        :return: The session, or None if the client isn't connected or isn't bound to a session
+        """
+        with self._clients_lock:
+            connection = self.clients_by_addr.get(address)
+            return connection.session if connection else None
+
+    def _bind(self, connection: ClientConnection, session: tuple):
+        """
+        Binds a connection to a session, instead of the session's and the connection's previous binding
+        (the clients lock must be held)
+        :param connection: The client's connection
+        :param session: The session
+        :return: -
+        """
+        if connection.session is not None:
+            del self.clients_by_session[connection.session]
+
+        previous = self.clients_by_session.get(session)
+        if previous is not None:
+            previous.session = None
+
+        connection.session = session
+        self.clients_by_session[session] = connection
+
+    def send_data(self, data, dst_addr) -> bool:
         """
         Send data to a client or a list of clients
         :param data: The data to send
-        :param dst_addr: The destination ip
-        :return: -
+        :param dst_addr: The destination session, (ip, port) address or ip
+        :return: True if the data was queued for every destination
         """
-        # Make the dst_addr a list
-        if type(dst_addr) != list:
-            dst_addr = [dst_addr]
+        return self._send_message(data, dst_addr, 4)
 
-        # Loop over all the ips to send to
-        for ip in dst_addr:
-            # The socket of the ip
-            soc = self._get_sock_by_ip(ip)
-            # Check if the socket is still connected to the server
-            if soc and soc in self.open_clients.keys():
-                try:
-                    # encrypt the data
-                    enc_data = AESCipher.encrypt(self.open_clients[soc][1], data).encode()
-                    # Send the length of the data
-                    soc.send(str(len(enc_data)).zfill(4).encode())
-                    # send the encrypted data
-                    soc.send(enc_data)
-                except socket.error:
-                    # close the client, remove it from the list of open clients
-                    self._close_client(soc)
-
-    def send_file(self, contents, dst_addr):
+    def send_file(self, contents, dst_addr) -> bool:
         """
         Send a file to a client or a list of clients
         :param contents: The data to send
-        :param dst_addr: The destination ip
-        :return: -
+        :param dst_addr: The destination session, (ip, port) address or ip
+        :return: True if the file was queued for every destination
+        """
+        return self._send_message(contents, dst_addr, 10)
+
+    def _send_message(self, data, dst_addr, header_size: int) -> bool:
+        """
+        Encrypts a message and queues it to a client or a list of clients, the event loop sends it
+        :param data: The data to send
+        :param dst_addr: The destination session, (ip, port) address or ip
+        :param header_size: The length of the size header of the message (for legacy clients)
+        :return: True if the message was queued for every destination
         """
         # Make the dst_addr a list
         if type(dst_addr) != list:
             dst_addr = [dst_addr]
 
+        all_queued = True
+        # Encode the data once for all the v2 clients
+        data_bytes = data.encode()
+
         # Loop over all the ips to send to
-        for ip in dst_addr:
-            # The socket of the ip
-            soc = self._get_sock_by_ip(ip)
-            # Check if the socket is still connected to the server
-            if soc and soc in self.open_clients.keys():
-                try:
-                    # encrypt the data
-                    enc_data = AESCipher.encrypt(self.open_clients[soc][1], contents).encode()
-                    # Send the length of the data
-                    soc.send(str(len(enc_data)).zfill(10).encode())
-                    # send the encrypted data
-                    soc.send(enc_data)
-                except socket.error:
-                    # close the client, remove it from the list of open clients
-                    self._close_client(soc)
+        for address in dst_addr:
+            connection = self._get_connection(address)
+            # Check if the client is still connected to the server
+            if connection is None:
+                all_queued = False
+                continue
+
+            if connection.version == VERSION_2:
+                # Send the raw encrypted bytes after a binary header
+                frame = BinaryFrameDecoder.encode(connection.cipher.encrypt(data_bytes))
+            else:
+                # encrypt the data
+                enc_data = AESCipher.encrypt(connection.cipher, data).encode()
+                # Add the length of the data before the encrypted data
+                frame = FrameDecoder.encode(enc_data, header_size)
+            if not self._queue_frame(connection, frame):
+                all_queued = False
+
+        return all_queued
+
+    def _queue_frame(self, connection: ClientConnection, frame: bytes) -> bool:
+        """
+        Adds a frame to the outbound queue of a client
+        :param connection: The client's connection
+        :param frame: The frame to send
+        :return: True if the frame was queued
+        """
+        with connection.lock:
+            if connection.closed:
+                return False
+
+            # The client doesn't read fast enough
+            is_slow = connection.congested
+            if is_slow and self.slow_consumer_policy == 'disconnect':
+                # Stop queueing messages to the client until it is closed by the event loop
+                connection.closed = True
+            start_writing = False
+            if not is_slow:
+                connection.out_queue.append(frame)
+                connection.out_size += len(frame)
+                if connection.out_size >= self.high_watermark:
+                    connection.congested = True
+
+                # Ask the event loop to watch the socket for writability
+                start_writing = not connection.writing
+                connection.writing = True
+
+        # Apply the slow consumer policy
+        if is_slow:
+            if connection.closed:
+                if self.log:
+                    print(f'{self.com_type.upper()}: disconnecting slow client', connection.ip)
+                self._close_client(connection.socket)
+            return False
+
+        if start_writing:
+            self._call_soon(self._watch_writes, connection)
+
+        return True
+
+    def stream_file(self, message: str, path: str, dst_addr, offset: int = 0, length: int = None) -> bool:
+        """
+        Streams a stored file to a v2 client. The message is sent first and then the file is sent in chunk frames,
+        the event loop produces the chunks while the client drains its outbound queue
+        :param message: The protocol message to send before the file's chunks
+        :param path: The path of the file
+        :param dst_addr: The destination session, (ip, port) address or ip
+        :param offset: The offset of the first byte of the file to send
+        :param length: The amount of bytes to send, defaults to the rest of the file
+        :return: True if the transfer was queued
+        """
+        connection = self._get_connection(dst_addr)
+        # Only v2 clients can tell chunk frames apart
+        if connection is None or connection.version != VERSION_2:
+            return False
+
+        try:
+            transfer = FileTransfer(path, message, offset, length)
+        except OSError:
+            return False
+
+        with connection.lock:
+            if connection.closed:
+                transfer.close()
+                return False
+
+            connection.transfers.append(transfer)
+            # Ask the event loop to watch the socket for writability
+            start_writing = not connection.writing
+            connection.writing = True
+
+        if start_writing:
+            self._call_soon(self._watch_writes, connection)
+
+        return True
+
+    def supports_streaming(self, address) -> bool:
+        """
+        Checks if a client can receive streamed files
+        :param address: The client's session, (ip, port) address or ip
+        :return: True if the client is connected and can receive streamed files
+        """
+        return self.get_version(address) == VERSION_2
+
+    def get_version(self, address):
+        """
+        Returns the framing version that was negotiated with a client
+        :param address: The client's session, (ip, port) address or ip
+        :return: The version, or None if the client isn't connected
+        """
+        connection = self._get_connection(address)
+        return connection.version if connection else None
+
+    def get_transfers(self) -> list:
+        """
+        Returns the progress of the file transfers that are streamed to clients
+        :return: A list of dicts with the client's address, the path, the range's offset and length,
+        the amount of bytes sent and the time it took so far
+        """
+        with self._clients_lock:
+            connections = list(self.clients_by_addr.values())
+
+        transfers = []
+        for connection in connections:
+            for transfer in list(connection.transfers):
+                progress = transfer.progress()
+                progress['addr'] = connection.addr
+                transfers.append(progress)
+
+        return transfers
+
+    def _produce_chunks(self, connection: ClientConnection):
+        """
+        Queues the next chunks of a client's file transfers while its queued output is below the transfer window
+        :param connection: The client's connection
+        :return: -
+        """
+        while connection.transfers and connection.out_size < self.TRANSFER_WINDOW:
+            transfer = connection.transfers[0]
+            if not transfer.started:
+                # Send the message of the transfer right before its chunks
+                frame = BinaryFrameDecoder.encode(connection.cipher.encrypt(transfer.message.encode()))
+                transfer.started = True
+            else:
+                # Encrypt a slice of the mapped file
+                chunk = transfer.next_chunk(self.TRANSFER_CHUNK_SIZE)
+                frame = BinaryFrameDecoder.encode(connection.cipher.encrypt(chunk), FRAME_FLAG_CHUNK)
+                chunk.release()
+
+            with connection.lock:
+                connection.out_queue.append(frame)
+                connection.out_size += len(frame)
+
+            if transfer.is_done():
+                connection.transfers.popleft()
+                transfer.close()
+                if self.log:
+                    print(f'{self.com_type.upper()}: streamed {transfer.end - transfer.start} bytes to', connection.ip)
+
+    def _watch_writes(self, connection: ClientConnection):
+        """
+        Starts watching a client's socket for writability since it has pending output
+        :param connection: The client's connection
+        :return: -
+        """
+        if not connection.closed:
+            try:
+                self.selector.modify(connection.socket, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            except KeyError:
+                # The client isn't registered yet, it will be watched for writability when it is
+                pass
+
+    def _send_pending(self, connection: ClientConnection):
+        """
+        Sends as much of a client's outbound queue as its socket accepts without blocking
+        :param connection: The client's connection
+        :return: -
+        """
+        self._produce_chunks(connection)
+
+        while connection.out_queue:
+            frame = connection.out_queue[0]
+            try:
+                sent = connection.socket.send(frame)
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error:
+                # close the client, remove it from the list of open clients
+                self._close_client(connection.socket)
+                return
+
+            with connection.lock:
+                connection.out_size -= sent
+            if sent < len(frame):
+                # Keep the rest of the frame without copying it
+                connection.out_queue[0] = memoryview(frame)[sent:]
+                break
+            connection.out_queue.popleft()
+            # Keep the file transfers flowing while the socket accepts data
+            self._produce_chunks(connection)
+
+        with connection.lock:
+            # Let the handlers queue messages again once the client has caught up
+            if connection.out_size <= self.low_watermark:
+                connection.congested = False
+
+            # Stop watching for writability when there is nothing left to send
+            if not connection.out_queue and not connection.transfers:
+                connection.writing = False
+                self.selector.modify(connection.socket, selectors.EVENT_READ)
 
     def _close_client(self, client_socket: socket.socket):
         """
@@ -233,27 +699,47 @@ class ServerCom:
         :param client_socket: the client socket to disconnect
         :return: -
         """
+        # The selector can only be changed by the event loop's thread
+        if not self._in_loop_thread():
+            self._call_soon(self._close_client, client_socket)
+            return
 
         if client_socket in self.open_clients.keys():
+            connection = self.open_clients[client_socket]
+            with connection.lock:
+                # Stop queueing messages to the client
+                connection.closed = True
+            # Stop the file transfers to the client
+            while connection.transfers:
+                connection.transfers.popleft().close()
             if self.log:
-                print(f'{self.com_type.upper()}: client disconnected', self.open_clients[client_socket][0])
+                print(f'{self.com_type.upper()}: client disconnected', self.open_clients[client_socket].ip)
+            # Delete the user from the dict of open clients and from the address indexes
+            with self._clients_lock:
+                session = connection.session
+                if session is not None:
+                    del self.clients_by_session[session]
+                del self.open_clients[client_socket]
+                del self.clients_by_addr[connection.addr]
+                del self.clients_by_ip[connection.ip][connection.addr]
+                if not self.clients_by_ip[connection.ip]:
+                    del self.clients_by_ip[connection.ip]
             # Let the main program know that a user has disconnected by sending an empty message
-            self.message_queue.put(('', self.open_clients[client_socket][0]))
-            # Delete the user from the dict of open clients
-            del self.open_clients[client_socket]
+            self.message_queue.put(('', session or connection.addr))
+
+        # Stop watching the socket
+        try:
+            self.selector.unregister(client_socket)
+        except (KeyError, ValueError):
+            # The socket was never registered (or it was already closed)
+            pass
 
         client_socket.close()
 
-    def is_connected(self, client_addr: str):
+    def is_connected(self, client_addr):
         """
         Checks if a client is connected
-        :param client_addr: The address of the client
+        :param client_addr: The client's session, (ip, port) address or ip
         :return: If the client is connected
         """
-        flag = False
-        for ip, key in self.open_clients.values():
-            if ip == client_addr:
-                flag = True
-                break
-
-        return flag
+        return self._get_connection(client_addr) is not None
@@ -23,7 +23,8 @@ class Protocol:
         'user_status': 12,
         'friend_added': 13,
         'friend_list': 14,
-        'keys': 15
+        'keys': 15,
+        'session_token': 16
     }
     chat_opcodes = {
         'text_message': 1,
@@ -32,7 +33,10 @@ class Protocol:
     }
     files_opcodes = {
         'file_in_chat': 1,
-        'user_profile_picture': 2
+        'user_profile_picture': 2,
+        'file_download': 3,
+        'file_range': 4,
+        'upload_offset': 5
     }
 
     # Opcodes to read messages (client -> server)
@@ -64,11 +68,16 @@ class Protocol:
     }
     c_chat_opcodes = {
         1: 'text_message',
-        2: 'file_description'
+        2: 'file_description',
+        3: 'bind_session'
     }
     c_files_opcodes = {
         1: 'file_in_chat',
-        2: 'profile_pic_change'
+        2: 'profile_pic_change',
+        3: 'file_upload_start',
+        4: 'request_file_range',
+        5: 'file_upload_resume',
+        6: 'bind_session'
     }
 
     # Parameters of every message from the client
@@ -82,7 +91,7 @@ class Protocol:
         'change_username': ('new_username',),
         'change_status': ('new_status',),
         'change_password': ('old_password', 'new_password'),
-        'get_chat_history': ('chat_id',),
+        'get_chat_history': ('chat_id', 'before_id', 'limit'),
         'request_file': ('file_hash',),
         'remove_friend': ('friend_username',),
         'join_voice': ('chat_id',),
@@ -96,11 +105,20 @@ class Protocol:
         'accept_friend': ('friend_username', 'is_accepted',),
         'profile_pic_change': ('picture',),
         'file_in_chat': ('chat_id', 'file_name', 'file'),
+        'file_upload_start': ('chat_id', 'file_name', 'file_size'),
+        'request_file_range': ('file_hash', 'offset', 'length'),
+        'file_upload_resume': ('chat_id', 'file_name', 'file_size', 'file_hash'),
         'file_description': ('chat_id', 'sender', 'file_name', 'file_size', 'file_hash',),
         'request_friend_list': (),
         'logout': (),
         'request_keys': (),
-        'request_user_picture_check': ('username', 'pfp_hash')
+        'request_user_picture_check': ('username', 'pfp_hash'),
+        'bind_session': ('token',)
+    }
+
+    # Trailing parameters that a client can leave out (clients from before they were added don't send them)
+    c_optional_params = {
+        'get_chat_history': ('before_id', 'limit')
     }
 
     @staticmethod
@@ -412,6 +430,66 @@ class Protocol:
         # Return the constructed message
         return msg
 
+    @staticmethod
+    def file_download(chat_id, file_name, file_size, file_hash):
+        """
+        Construct a message that starts a streamed file download, the file's chunks are sent after it.
+
+        :param chat_id: (str) the id of the chat the file was sent to
+        :param file_name: (str) the name of the file
+        :param file_size: (int) the size of the file (in bytes)
+        :param file_hash: (str) the hash of the file
+        :return: (str) the constructed message
+        """
+        # Get the opcode of the file_download
+        kind = Protocol.files_opcodes['file_download']
+        # Construct the message with opcode and the file's information
+        msg = f"{kind}{Protocol.FIELD_SEPARATOR}{chat_id}{Protocol.FIELD_SEPARATOR}{file_name}" \
+              f"{Protocol.FIELD_SEPARATOR}{file_size}{Protocol.FIELD_SEPARATOR}{file_hash}"
+        # Return the constructed message
+        return msg
+
+    @staticmethod
+    def file_range(chat_id, file_name, file_size, file_hash, offset, length):
+        """
+        Construct a message that starts a streamed download of a byte range of a file,
+        the range's chunks are sent after it.
+
+        :param chat_id: (str) the id of the chat the file was sent to
+        :param file_name: (str) the name of the file
+        :param file_size: (int) the size of the whole file (in bytes)
+        :param file_hash: (str) the hash of the file
+        :param offset: (int) the offset of the range's first byte
+        :param length: (int) the length of the range (in bytes)
+        :return: (str) the constructed message
+        """
+        # Get the opcode of the file_range
+        kind = Protocol.files_opcodes['file_range']
+        # Construct the message with opcode, the file's information and the range
+        msg = f"{kind}{Protocol.FIELD_SEPARATOR}{chat_id}{Protocol.FIELD_SEPARATOR}{file_name}" \
+              f"{Protocol.FIELD_SEPARATOR}{file_size}{Protocol.FIELD_SEPARATOR}{file_hash}" \
+              f"{Protocol.FIELD_SEPARATOR}{offset}{Protocol.FIELD_SEPARATOR}{length}"
+        # Return the constructed message
+        return msg
+
+    @staticmethod
+    def upload_offset(chat_id, file_hash, offset):
+        """
+        Construct a message that tells a client where to resume an upload from.
+
+        :param chat_id: (str) the id of the chat the file is uploaded to
+        :param file_hash: (str) the hash of the uploaded file
+        :param offset: (int) the amount of bytes of the file the server already has
+        :return: (str) the constructed message
+        """
+        # Get the opcode of the upload_offset
+        kind = Protocol.files_opcodes['upload_offset']
+        # Construct the message with opcode and the upload's offset
+        msg = f"{kind}{Protocol.FIELD_SEPARATOR}{chat_id}{Protocol.FIELD_SEPARATOR}{file_hash}" \
+              f"{Protocol.FIELD_SEPARATOR}{offset}"
+        # Return the constructed message
+        return msg
+
     @staticmethod
     def profile_picture(profile_username, picture_contents):
         """
@@ -430,28 +508,29 @@ class Protocol:
         return msg
 
     @staticmethod
-    def chat_history(messages, chat_id):
+    def chat_history(messages, chat_id, oldest_id=None):
         """
         Construct a message with a list of chat history messages.
 
         :param chat_id: the id of the chat the messages belong to
         :type chat_id: int
-        :param messages: (list) a list of messages representing the chat history
+        :param messages: (list) a list of messages representing the chat history (can be empty)
+        :param oldest_id: the id of the oldest message in the list, the next page is requested before it
+        :type oldest_id: int
         :return: (str) the constructed message
         """
         # Get the opcode of the chat_history
         kind = Protocol.chat_opcodes['chat_history']
-        # Construct the message with opcode and the first message from the list
+        # Construct the message with opcode and the messages from the list
         msg = f"{kind}{Protocol.FIELD_SEPARATOR}"
-        msg += messages[0]
-
-        # Add the rest of the messages to the message
-        if len(messages) > 1:
-            for message in messages[1:]:
-                msg += Protocol.LIST_SEPARATOR + message
+        msg += Protocol.LIST_SEPARATOR.join(messages)
 
         msg += f'{Protocol.FIELD_SEPARATOR}{chat_id}'
 
+        # Add the id to continue the history from
+        if oldest_id is not None:
+            msg += f'{Protocol.FIELD_SEPARATOR}{oldest_id}'
+
         # Return the constructed message
         return msg
 
@@ -472,6 +551,19 @@ class Protocol:
               f"{Protocol.FIELD_SEPARATOR}{Protocol.LIST_SEPARATOR.join(keys)}"
         return msg
 
+    @staticmethod
+    def session_token(token: str):
+        """
+        Construct a message with the token of a client's session, the client sends it on the chats and files channels
+        to bind them to the session.
+        :param token: The session's token
+        :return: The constructed message
+        :rtype: str
+        """
+        opcode = Protocol.general_opcodes['session_token']
+        msg = f"{str(opcode).zfill(2)}{Protocol.FIELD_SEPARATOR}{token}"
+        return msg
+
     @staticmethod
     def unprotocol_msg(msg_type: str, raw_message: str):
         """
@@ -522,8 +614,12 @@ class Protocol:
 
         # Assign a value for each parameter in a dict
         for i in range(len(params_names)):
-            value = values[i]
             param_name = params_names[i]
+            # Optional trailing parameters that weren't sent are left out, a missing required one raises IndexError
+            if i >= len(values) and param_name in Protocol.c_optional_params.get(opcode_name, ()):
+                break
+
+            value = values[i]
 
             # If the value is a list
             if len(value.split(Protocol.LIST_SEPARATOR)) > 1:
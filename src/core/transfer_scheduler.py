@@ -0,0 +1,216 @@
+import threading
+import time
+from collections import deque
+
+
+class TransferScheduler:
+    """
+    Runs the handlers of file transfers on a fixed pool of worker threads.
+    The total size of the running transfers is limited by a byte budget, every user runs a limited amount of
+    transfers at once, and the users with queued transfers take turns (round robin), so one user's burst of
+    uploads doesn't hold back the others. A transfer that doesn't fit the budget is passed over for smaller ones,
+    until it waited MAX_WAIT, then its size is held back from the budget until it runs
+    (the user limits still apply, so a user at its limit doesn't hold back anyone).
+    """
+
+    WORKERS = 4  # The default amount of worker threads
+    BYTE_BUDGET = 64 * 1024 * 1024  # The default max total size of the running transfers (in bytes)
+    MAX_QUEUED_BYTES = 256 * 1024 * 1024  # The default max total size of the queued transfers (in bytes)
+    USER_LIMIT = 2  # The default max amount of running transfers of one user
+    MAX_WAIT = 5  # The time a transfer waits before its size is held back from the budget (in seconds)
+
+    def __init__(self, name, workers=WORKERS, byte_budget=BYTE_BUDGET, max_queued_bytes=MAX_QUEUED_BYTES,
+                 user_limit=USER_LIMIT, max_wait=MAX_WAIT, log=False):
+        """
+        Creates the scheduler, the workers start with start()
+        :param name: The scheduler's name (for the threads' names and the log)
+        :param workers: The amount of worker threads
+        :param byte_budget: The max total size of the running transfers (in bytes)
+        :param max_queued_bytes: The max total size of the queued transfers (in bytes)
+        :param user_limit: The max amount of running transfers of one user
+        :param max_wait: The time a transfer waits before its size is held back from the budget (in seconds)
+        :param log: Whether to print the transfers that failed
+        """
+        self.name = name
+        self.workers = workers
+        self.byte_budget = byte_budget
+        self.max_queued_bytes = max_queued_bytes
+        self.user_limit = user_limit
+        self.max_wait = max_wait
+        self.log = log
+
+        self.condition = threading.Condition()
+        self.queues = {}  # The queued transfers of every user (opname, size, handler, args, submit time)
+        self.turns = deque()  # The users with queued transfers, in the order of their turns
+        self.running = {}  # The amount of running transfers of every user
+        self.in_flight = 0  # The total size of the running transfers (in bytes)
+        self.queued_bytes = 0  # The total size of the queued transfers (in bytes)
+        self.closing = False
+        self.threads = []
+
+        # Metrics
+        self.queued = 0  # The amount of queued transfers
+        self.completed = 0  # The amount of transfers that ran
+        self.rejected = 0  # The amount of transfers that didn't fit the queue
+        self.errors = 0  # The amount of transfers that raised
+        self.max_in_flight = 0  # The largest total size of the running transfers (in bytes)
+        self.total_wait = 0  # The total time transfers were queued (in seconds)
+        self.max_wait_time = 0  # The longest time a transfer was queued (in seconds)
+
+    def start(self):
+        """
+        Starts the worker threads
+        :return: -
+        """
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._main, name=f'{self.name}-{i}')
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, user, size: int, opname: str, handler, *args) -> bool:
+        """
+        Queues a transfer
+        :param user: The user (or session) the transfer belongs to
+        :param size: The transfer's size (in bytes)
+        :param opname: The name of the handled operation (for the log)
+        :param handler: The handler function
+        :param args: The handler's arguments
+        :return: True if the transfer was queued, False if the queue is full
+        """
+        with self.condition:
+            # Always accept a transfer when nothing is queued, so a big transfer isn't rejected forever
+            if self.queued_bytes and self.queued_bytes + size > self.max_queued_bytes:
+                self.rejected += 1
+                return False
+
+            if user not in self.queues:
+                self.queues[user] = deque()
+                self.turns.append(user)
+            self.queues[user].append((opname, size, handler, args, time.monotonic()))
+            self.queued += 1
+            self.queued_bytes += size
+            self.condition.notify()
+            return True
+
+    def close(self):
+        """
+        Stops the worker threads after the queued transfers
+        :return: -
+        """
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self) -> dict:
+        """
+        Returns the scheduler's metrics
+        :return: A dict with the amount of queued, running, completed, rejected and failed transfers,
+        the queued and in-flight bytes and the wait times
+        """
+        with self.condition:
+            return {'workers': self.workers, 'queued': self.queued, 'queued_bytes': self.queued_bytes,
+                    'running': sum(self.running.values()), 'in_flight': self.in_flight,
+                    'max_in_flight': self.max_in_flight, 'byte_budget': self.byte_budget,
+                    'completed': self.completed, 'rejected': self.rejected, 'errors': self.errors,
+                    'total_wait': self.total_wait, 'max_wait_time': self.max_wait_time}
+
+    def _main(self):
+        """
+        Runs the transfers that the scheduler picks
+        :return: -
+        """
+        while True:
+            with self.condition:
+                transfer = self._next_transfer()
+                while transfer is None:
+                    if self.closing and not self.queued:
+                        return
+                    self.condition.wait()
+                    transfer = self._next_transfer()
+
+            user, opname, size, handler, args = transfer
+            try:
+                handler(*args)
+            except Exception as e:
+                with self.condition:
+                    self.errors += 1
+                if self.log:
+                    print(f'{self.name.upper()}: {opname} failed -', e)
+
+            with self.condition:
+                self.in_flight -= size
+                self.running[user] -= 1
+                if not self.running[user]:
+                    del self.running[user]
+                self.completed += 1
+                # The freed budget may let a few queued transfers run
+                self.condition.notify_all()
+
+    def _next_transfer(self):
+        """
+        Picks the next transfer to run and reserves its budget (the lock must be held)
+        :return: The transfer (user, opname, size, handler, args), or None if no transfer can run now
+        """
+        now = time.monotonic()
+
+        # The oldest transfer that waited too long, of a user that can run another transfer
+        aged_user = min((user for user in self.turns
+                         if now - self.queues[user][0][4] >= self.max_wait
+                         and self.running.get(user, 0) < self.user_limit),
+                        key=lambda user: self.queues[user][0][4], default=None)
+
+        # The budget that is held back for a transfer that waited too long, until it fits
+        reserved = 0
+        if aged_user is not None:
+            if self._can_run(aged_user):
+                return self._take(aged_user, now)
+            reserved = self.queues[aged_user][0][1]
+
+        # The users take turns, a user that can't run now keeps its place
+        for i in range(len(self.turns)):
+            user = self.turns[i]
+            if self._can_run(user, reserved):
+                return self._take(user, now)
+
+        return None
+
+    def _can_run(self, user, reserved: int = 0) -> bool:
+        """
+        Checks if the user's next transfer can run now (the lock must be held)
+        :param user: The user
+        :param reserved: The budget that is held back for another transfer (in bytes)
+        """
+        size = self.queues[user][0][1]
+        # A transfer bigger than the budget runs alone
+        fits = self.in_flight + reserved + size <= self.byte_budget or not (self.in_flight or reserved)
+        return fits and self.running.get(user, 0) < self.user_limit
+
+    def _take(self, user, now: float):
+        """
+        Removes the user's next transfer from the queue and reserves its budget (the lock must be held)
+        :param user: The user
+        :param now: The current time (time.monotonic())
+        :return: The transfer (user, opname, size, handler, args)
+        """
+        transfers = self.queues[user]
+        opname, size, handler, args, submit_time = transfers.popleft()
+
+        # The user's turn is over, it goes to the end of the line if it has more transfers
+        self.turns.remove(user)
+        if transfers:
+            self.turns.append(user)
+        else:
+            del self.queues[user]
+
+        self.queued -= 1
+        self.queued_bytes -= size
+        self.in_flight += size
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.running[user] = self.running.get(user, 0) + 1
+
+        waited = now - submit_time
+        self.total_wait += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        return user, opname, size, handler, args
@@ -3,6 +3,9 @@ import sqlite3
 import datetime
 import time
 from src.core.cryptions import AESCipher
+from src.handlers.identity_cache import IdentityCache
+from src.handlers.membership_index import MembershipIndex
+from src.handlers.migrations import Migrator
 
 
 class DBHandler:
@@ -10,25 +13,46 @@ class DBHandler:
     Class for handling the server's database
     """
 
-    def __init__(self, db_name):
+    MMAP_SIZE = 256 * 1024 * 1024  # The size of the memory map of the database file (in bytes)
+    CACHE_SIZE = 16 * 1024 * 1024  # The size of the page cache of every connection (in bytes)
+
+    def __init__(self, db_name, create_tables=True, check_same_thread=True):
+        """
+        Connects to the database
+        :param db_name: The database's name
+        :param create_tables: Whether to create the tables (it's skipped when the schema was already created)
+        :param check_same_thread: Whether the connection can only be used by the thread that created it
+        """
         # The database's name
         self.db_name = db_name
         # Connect to the database file
-        self.con = sqlite3.connect(self.db_name + '.db')
+        self.con = sqlite3.connect(self.db_name + '.db', check_same_thread=check_same_thread)
         self.cursor = self.con.cursor()
+        self._configure_connection()
+        # Whether the changes are committed by a DBWriter instead of by every method
+        self.batched = False
+        # The username <-> unique id cache that is shared by the handlers of the database
+        self.identities = IdentityCache.for_database(db_name)
+        # The index of the groups' members that is shared by the handlers of the database
+        self.memberships = MembershipIndex.for_database(db_name)
 
         # The max length of a chat message
         self.MAX_MSG_LEN = 200  # Characters
-        self.MAX_MESSAGES_HISTORY = 50  # Messages
+        self.MAX_MESSAGES_HISTORY = None  # Messages kept in every chat (None keeps all of them)
+        self.HISTORY_PAGE_SIZE = 30  # Messages
+        self.MAX_HISTORY_PAGE_SIZE = 100  # Messages
 
         # Create the tables
-        self._create_users_table()
-        self._create_groups_table()
-        self._create_participants_table()
-        self._create_files_table()
-        self._create_messages_table()
-        self._create_friends_table()
-        self._create_keys_table()
+        if create_tables:
+            self._create_users_table()
+            self._create_groups_table()
+            self._create_participants_table()
+            self._create_files_table()
+            self._create_messages_table()
+            self._create_friends_table()
+            self._create_keys_table()
+            self._create_private_chats_table()
+            self._upgrade_schema()
 
         # Default profile pic and status for new users
         self.DEFAULT_PROFILE_PICTURES = ['placeholder1.png', 'placeholder2.png', 'placeholder3.png', 'placeholder4.png',
@@ -40,6 +64,43 @@ class DBHandler:
         self.NOT_ENOUGH_PARAMETERS_EXCEPTION = Exception('Not enough parameters given.')
         self.USER_DOESNT_EXIST_EXCEPTION = Exception("User doesn't exist.")
 
+    def load_memberships(self):
+        """
+        Loads the index of the groups' members (it's only loaded once for every database)
+        :return: -
+        """
+        self.memberships.load(self.cursor)
+
+    def _commit(self):
+        """
+        Commits the changes, unless they are committed by a DBWriter in batches
+        :return: -
+        """
+        if not self.batched:
+            self.con.commit()
+
+    def _configure_connection(self):
+        """
+        Sets the performance pragmas of the connection
+        :return: -
+        """
+        # Readers don't block the writer (and the other way around) in WAL mode
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode the database stays consistent without syncing on every commit
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        # Read the database through a memory map
+        self.cursor.execute(f"PRAGMA mmap_size={DBHandler.MMAP_SIZE}")
+        # A negative size is in KiB
+        self.cursor.execute(f"PRAGMA cache_size=-{DBHandler.CACHE_SIZE // 1024}")
+        self.cursor.execute("PRAGMA temp_store=MEMORY")
+
+    def _upgrade_schema(self):
+        """
+        Applies the pending migrations of the schema
+        :return: -
+        """
+        Migrator(self.con).migrate()
+
     def _create_users_table(self):
         """
         Creates the users table in the db
@@ -61,7 +122,8 @@ class DBHandler:
         sql = f"CREATE TABLE IF NOT EXISTS groups_table (" \
               f"chat_id INTEGER PRIMARY KEY," \
               f" group_name TEXT," \
-              f" date_of_creation DATE) "
+              f" date_of_creation DATE," \
+              f" message_count INTEGER DEFAULT 0) "
         self.cursor.execute(sql)
 
     def _create_participants_table(self):
@@ -91,10 +153,11 @@ class DBHandler:
         :return: -
         """
         sql = f"CREATE TABLE IF NOT EXISTS messages_table (" \
-              f"chat_id INT," \
+              f"message_id INTEGER PRIMARY KEY AUTOINCREMENT," \
+              f" chat_id INT," \
               f" timestamp INT," \
-              f" sender_unique_id INT, " \
-              f" message varbinary({self.MAX_MSG_LEN}))"
+              f" sender_unique_id INT," \
+              f" message TEXT)"
         self.cursor.execute(sql)
 
     def _create_friends_table(self):
@@ -119,6 +182,17 @@ class DBHandler:
               f" key TEXT)"
         self.cursor.execute(sql)
 
+    def _create_private_chats_table(self):
+        """
+        Creates the private chats table in the db (the two friends of every private chat)
+        :return: -
+        """
+        sql = f"CREATE TABLE IF NOT EXISTS private_chats_table (" \
+              f"chat_id INTEGER PRIMARY KEY," \
+              f" user1_id INT," \
+              f" user2_id INT)"
+        self.cursor.execute(sql)
+
     def add_key(self, username, chat_id, key, user_password):
         """
         Adds a key to the keys table
@@ -139,7 +213,7 @@ class DBHandler:
         sql = f"INSERT INTO keys_table (user_id, chat_id, key) " \
               f"VALUES (?, ?, ?) "
         self.cursor.execute(sql, data)
-        self.con.commit()
+        self._commit()
 
     def get_user_keys(self, username, user_password):
         """
@@ -185,7 +259,10 @@ class DBHandler:
             sql = f"INSERT INTO users_table (username, password, picture, status) " \
                   f"VALUES (?, ?, '{random.choice(self.DEFAULT_PROFILE_PICTURES)}', '{self.DEFAULT_STATUS}') "
             self.cursor.execute(sql, data)
-            self.con.commit()
+            self._commit()
+            # Cache the new user once it's committed
+            if not self.batched:
+                self.identities.put(username, self.cursor.lastrowid)
 
         return flag
 
@@ -195,10 +272,7 @@ class DBHandler:
         :param username: The username
         :return: True if exists of False if not
         """
-        sql = f"SELECT * from users_table WHERE username=?"
-        self.cursor.execute(sql, [username])
-        result = self.cursor.fetchall()
-        return len(result) == 1
+        return self._get_unique_id(username) is not None
 
     def _user_exists_id(self, user_id):
         """
@@ -206,10 +280,7 @@ class DBHandler:
         :param user_id: The user's id
         :return: True if exists, false if it doesn't
         """
-        sql = f"SELECT * from users_table WHERE unique_id=?"
-        self.cursor.execute(sql, [user_id])
-        result = self.cursor.fetchall()
-        return len(result) == 1
+        return self._get_username(user_id) is not None
 
     def change_password(self, username, new_password):
         """
@@ -220,7 +291,7 @@ class DBHandler:
         """
         sql = f"UPDATE users_table SET password=? WHERE username=?"
         self.cursor.execute(sql, [new_password, username])
-        self.con.commit()
+        self._commit()
 
     def change_username(self, old_username, new_username):
         """
@@ -235,7 +306,8 @@ class DBHandler:
         else:
             sql = f"UPDATE users_table SET username=? WHERE username=?"
             self.cursor.execute(sql, [new_username, old_username])
-            self.con.commit()
+            self._commit()
+            self.identities.invalidate(username=old_username)
 
         return flag
 
@@ -255,10 +327,14 @@ class DBHandler:
             sql = f"INSERT INTO friends_table (user_id, friend_id) " \
                   f"VALUES (?, ?)"
             self.cursor.execute(sql, data)
-            self.con.commit()
+            self._commit()
             # Create a group to represent the private chat between two friends
             chat_id = self._create_group(f'PRIVATE%%{user_id}%%{friend_id}', username)
             self._add_to_group(chat_id, friend)
+            # Keep the friends of the private chat
+            sql = f"INSERT INTO private_chats_table (chat_id, user1_id, user2_id) VALUES (?, ?, ?)"
+            self.cursor.execute(sql, [chat_id, user_id, friend_id])
+            self._commit()
 
         return chat_id
 
@@ -290,15 +366,11 @@ class DBHandler:
         chat_id = None
 
         if self._are_friends(user_id, friend_id):
-            sql = f"SELECT chat_id FROM groups_table WHERE group_name=?"
-            self.cursor.execute(sql, [f'PRIVATE%%{user_id}%%{friend_id}'])
+            sql = f"SELECT chat_id FROM private_chats_table " \
+                  f"WHERE (user1_id=? AND user2_id=?) OR (user1_id=? AND user2_id=?)"
+            self.cursor.execute(sql, [user_id, friend_id, friend_id, user_id])
             result = self.cursor.fetchall()
-            if len(result) == 1:
-                chat_id = result[0][0]
-            else:
-                sql = f"SELECT chat_id FROM groups_table WHERE group_name=?"
-                self.cursor.execute(sql, [f'PRIVATE%%{friend_id}%%{user_id}'])
-                result = self.cursor.fetchall()
+            if len(result) > 0:
                 chat_id = result[0][0]
 
         return chat_id
@@ -315,15 +387,20 @@ class DBHandler:
 
         sql = f"DELETE FROM groups_table WHERE chat_id=?"
         self.cursor.execute(sql, [chat_id])
-        self.con.commit()
+        self._commit()
         # Remove all the users from the participants table
         sql = f"DELETE FROM participants_table WHERE chat_id=?"
         self.cursor.execute(sql, [chat_id])
-        self.con.commit()
+        self._commit()
+        self.memberships.remove_chat(chat_id)
         # Delete the chat history of the group in the messages table
         sql = f"DELETE FROM messages_table WHERE chat_id=?"
         self.cursor.execute(sql, [chat_id])
-        self.con.commit()
+        self._commit()
+        # Remove the group from the private chats table (if it's a private chat)
+        sql = f"DELETE FROM private_chats_table WHERE chat_id=?"
+        self.cursor.execute(sql, [chat_id])
+        self._commit()
 
     def remove_friend(self, username, friend):
         """
@@ -347,14 +424,14 @@ class DBHandler:
             sql = "DELETE FROM friends_table " \
                   "WHERE (user_id=? AND friend_id=?) OR (friend_id=? AND user_id=?)"
             self.cursor.execute(sql, data)
-            self.con.commit()
+            self._commit()
 
             # delete from the keys table
             sql = "DELETE FROM keys_table WHERE user_id=? AND chat_id=?"
             self.cursor.execute(sql, [user_id, chat_id])
-            self.con.commit()
+            self._commit()
             self.cursor.execute(sql, [friend_id, chat_id])
-            self.con.commit()
+            self._commit()
 
     def _are_friends(self, user1_id: int, user2_id: int) -> bool:
         """
@@ -378,16 +455,21 @@ class DBHandler:
         :param username: The username
         :return: A list of the user's friends usernames
         """
-        user_id = self._get_unique_id(username)
-        data = [user_id, user_id]
-        sql = f"SELECT * from friends_table WHERE user_id=? OR friend_id=?"
-        self.cursor.execute(sql, data)
-        results = self.cursor.fetchall()
-
-        friends = []
-        for result in results:
-            friend_id = result[0] if result[0] != user_id else result[1]
-            friends.append(self._get_username(friend_id))
+        # Get the usernames of the friends on both sides of the friendships in one query
+        sql = f"""SELECT users_table.username
+                FROM users_table AS user
+                JOIN friends_table ON friends_table.user_id = user.unique_id
+                JOIN users_table ON users_table.unique_id = friends_table.friend_id
+                WHERE user.username = ?
+                UNION ALL
+                SELECT users_table.username
+                FROM users_table AS user
+                JOIN friends_table ON friends_table.friend_id = user.unique_id
+                JOIN users_table ON users_table.unique_id = friends_table.user_id
+                WHERE user.username = ?;
+                """
+        self.cursor.execute(sql, [username, username])
+        friends = [result[0] for result in self.cursor.fetchall()]
 
         return friends
 
@@ -397,12 +479,15 @@ class DBHandler:
         :param user_id: The user's id
         :return: The username of the user
         """
-        username = None
+        username = self.identities.get_username(user_id)
 
-        if self._user_exists_id(user_id):
+        if username is None:
             sql = f"SELECT username from users_table WHERE unique_id=?"
             self.cursor.execute(sql, [user_id])
-            username = self.cursor.fetchall()[0][0]
+            result = self.cursor.fetchall()
+            if len(result) == 1:
+                username = result[0][0]
+                self.identities.put(username, user_id)
 
         return username
 
@@ -422,7 +507,7 @@ class DBHandler:
             data = [new_password, username]
             sql = f"UPDATE users_table SET password=? WHERE username=?"
             self.cursor.execute(sql, data)
-            self.con.commit()
+            self._commit()
 
     def get_user_picture_path(self, username) -> str:
         """
@@ -453,7 +538,7 @@ class DBHandler:
             data = [picture_path, username]
             sql = f"UPDATE users_table SET picture=? WHERE username=?"
             self.cursor.execute(sql, data)
-            self.con.commit()
+            self._commit()
 
     def get_user_status(self, username):
         """
@@ -487,7 +572,7 @@ class DBHandler:
             data = [new_status, username]
             sql = "UPDATE users_table SET status=? WHERE username=?"
             self.cursor.execute(sql, data)
-            self.con.commit()
+            self._commit()
 
     @staticmethod
     def _group_name_valid(group_name):
@@ -520,11 +605,9 @@ class DBHandler:
             # Add the group to the groups table
             sql = f"INSERT INTO groups_table (group_name, date_of_creation) VALUES (?, ?)"
             self.cursor.execute(sql, data)
-            self.con.commit()
-            # Get the group id
-            sql = f"SELECT chat_id from groups_table WHERE group_name =? AND date_of_creation =?"
-            self.cursor.execute(sql, data)
-            result = self.cursor.fetchall()[-1][0]
+            # Get the group id (the row id of the insert, another group can have the same name and date)
+            result = self.cursor.lastrowid
+            self._commit()
 
             # Add the creator of the group to it
             self._add_to_group(result, creator)
@@ -544,11 +627,9 @@ class DBHandler:
         # Add the group to the groups table
         sql = f"INSERT INTO groups_table (group_name, date_of_creation) VALUES (?, ?)"
         self.cursor.execute(sql, data)
-        self.con.commit()
-        # Get the group id
-        sql = f"SELECT chat_id from groups_table WHERE group_name =? AND date_of_creation =?"
-        self.cursor.execute(sql, data)
-        result = self.cursor.fetchall()[-1][0]
+        # Get the group id (the row id of the insert, another group can have the same name and date)
+        result = self.cursor.lastrowid
+        self._commit()
 
         # Add the creator of the group to it
         self._add_to_group(result, creator)
@@ -575,8 +656,9 @@ class DBHandler:
         :param chat_id: The chat id of the chat
         :return: True if the chat is a private chat, false if not
         """
-        chat_name = self.get_group_name(chat_id)
-        return chat_name.startswith('PRIVATE') and len(chat_name.split('%%')) == 3
+        sql = f"SELECT chat_id FROM private_chats_table WHERE chat_id=?"
+        self.cursor.execute(sql, [chat_id])
+        return len(self.cursor.fetchall()) == 1
 
     def add_to_group(self, chat_id, adder, username):
         """
@@ -607,7 +689,8 @@ class DBHandler:
         else:
             sql = f"INSERT INTO participants_table (chat_id, participant_unique_id) VALUES (?, ?)"
             self.cursor.execute(sql, [chat_id, unique_id])
-            self.con.commit()
+            self._commit()
+            self.memberships.add(chat_id, unique_id)
 
         return flag
 
@@ -632,7 +715,8 @@ class DBHandler:
         else:
             sql = f"INSERT INTO participants_table (chat_id, participant_unique_id) VALUES ('{chat_id}', '{unique_id}')"
             self.cursor.execute(sql)
-            self.con.commit()
+            self._commit()
+            self.memberships.add(chat_id, unique_id)
 
         return flag
 
@@ -660,11 +744,8 @@ class DBHandler:
         if unique_id is None:
             raise self.USER_DOESNT_EXIST_EXCEPTION
 
-        data = [chat_id, unique_id]
-        sql = f"SELECT * from participants_table WHERE chat_id=? AND participant_unique_id=?"
-        self.cursor.execute(sql, data)
-        result = self.cursor.fetchall()
-        return len(result) == 1
+        self.load_memberships()
+        return self.memberships.is_member(chat_id, unique_id)
 
     def get_group_members(self, chat_id) -> list:
         """
@@ -674,17 +755,10 @@ class DBHandler:
         :return: A list of all the group members' usernames
         :rtype: list
         """
-        sql = """
-        SELECT users_table.username 
-        FROM participants_table 
-        INNER JOIN users_table 
-        ON participants_table.participant_unique_id = users_table.unique_id 
-        WHERE participants_table.chat_id = ?;
-        """
-        self.cursor.execute(sql, [chat_id])
-        result = self.cursor.fetchall()
-
-        result = [_[0] for _ in result]
+        self.load_memberships()
+        # Get the members from the index and their usernames from the identity cache
+        result = [self._get_username(user_id) for user_id in self.memberships.get_members(chat_id)]
+        result = [username for username in result if username is not None]
 
         return result
 
@@ -694,13 +768,16 @@ class DBHandler:
         :param username: The user's username
         :return: The user's unique id (if the user exists - otherwise None)
         """
-        result = None
-        # Check if user exists
-        if self._user_exists(username):
+        result = self.identities.get_id(username)
 
+        # Get the user from the database if it isn't cached
+        if result is None:
             sql = f"SELECT unique_id from users_table WHERE username=?"
             self.cursor.execute(sql, [username])
-            result = self.cursor.fetchall()[0][0]
+            rows = self.cursor.fetchall()
+            if len(rows) == 1:
+                result = rows[0][0]
+                self.identities.put(username, result)
 
         return result
 
@@ -750,7 +827,7 @@ class DBHandler:
         sql = f"INSERT INTO files_table (chat_id, file_name, file_hash) VALUES (" \
               f"?, ?, ?)"
         self.cursor.execute(sql, data)
-        self.con.commit()
+        self._commit()
 
     def remove_file(self, file_hash):
         """
@@ -762,7 +839,7 @@ class DBHandler:
         """
         sql = f"DELETE FROM files_table WHERE file_hash=?"
         self.cursor.execute(sql, [file_hash])
-        self.con.commit()
+        self._commit()
 
     def add_message(self, chat_id, sender_username, message: str):
         """
@@ -790,18 +867,24 @@ class DBHandler:
         sql = f"INSERT INTO messages_table (chat_id, timestamp, sender_unique_id, message) VALUES (" \
               f"?, ?, ?, ?)"
         self.cursor.execute(sql, data)
-        self.con.commit()
 
-        # Check the amount of messages in the chat that are stored in the database,
-        # and delete the oldest ones if there are more than 30
-        sql = f"SELECT * FROM messages_table WHERE chat_id=?"
+        # Count the message in the chat's counter
+        sql = f"UPDATE groups_table SET message_count = message_count + 1 WHERE chat_id=?"
         self.cursor.execute(sql, [chat_id])
-        result = self.cursor.fetchall()
-        if len(result) > self.MAX_MESSAGES_HISTORY:
-            # Delete the oldest message
-            sql = f"DELETE FROM messages_table WHERE chat_id=? AND timestamp=?"
-            self.cursor.execute(sql, [chat_id, result[0][1]])
-            self.con.commit()
+        sql = f"SELECT message_count FROM groups_table WHERE chat_id=?"
+        self.cursor.execute(sql, [chat_id])
+        message_count = self.cursor.fetchone()[0]
+
+        # Delete the oldest messages of the chat if there are more than MAX_MESSAGES_HISTORY
+        if self.MAX_MESSAGES_HISTORY is not None and message_count > self.MAX_MESSAGES_HISTORY:
+            extra = message_count - self.MAX_MESSAGES_HISTORY
+            sql = f"DELETE FROM messages_table WHERE message_id IN (" \
+                  f"SELECT message_id FROM messages_table WHERE chat_id=? ORDER BY message_id LIMIT ?)"
+            self.cursor.execute(sql, [chat_id, extra])
+            sql = f"UPDATE groups_table SET message_count = message_count - ? WHERE chat_id=?"
+            self.cursor.execute(sql, [self.cursor.rowcount, chat_id])
+
+        self._commit()
 
     def check_credentials(self, username, password) -> bool:
         """
@@ -811,25 +894,40 @@ class DBHandler:
         :return: True if the username and password match, false if not
         """
         data = [username, password]
-        sql = f"SELECT * FROM users_table WHERE username=? AND password=?"
+        sql = f"SELECT unique_id FROM users_table WHERE username=? AND password=?"
         self.cursor.execute(sql, data)
         result = self.cursor.fetchall()
+        # Cache the user that logs in
+        if len(result) == 1:
+            self.identities.put(username, result[0][0])
         return len(result) == 1
 
-    def get_chat_history(self, chat_id: int) -> list:
+    def get_chat_history(self, chat_id: int, before_id: int = None, limit: int = None) -> list:
         """
-        Get the chat history of a group/chat
+        Get a page of the chat history of a group/chat, from the newest message to the oldest one
         :param chat_id: The chat id
-        :return: A list of every message, and it's sender in the chat
+        :param before_id: Only messages older than the message with this id are returned (None for the newest page)
+        :param limit: The max amount of messages in the page (defaults to HISTORY_PAGE_SIZE)
+        :return: A list of the (message_id, message) of every message in the page, or None if there are none
         :rtype: list
         """
         if not self._group_exists(chat_id):
             raise self.GROUP_DOESNT_EXIST_EXCEPTION
 
-        sql = f"SELECT message FROM messages_table WHERE chat_id=? ORDER BY timestamp DESC LIMIT 30"
-        self.cursor.execute(sql, [chat_id])
+        if limit is None:
+            limit = self.HISTORY_PAGE_SIZE
+        limit = max(1, min(limit, self.MAX_HISTORY_PAGE_SIZE))
+
+        # Walk the (chat_id, message_id) index backwards from the page's start
+        if before_id is None:
+            sql = f"SELECT message_id, message FROM messages_table WHERE chat_id=? ORDER BY message_id DESC LIMIT ?"
+            self.cursor.execute(sql, [chat_id, limit])
+        else:
+            sql = f"SELECT message_id, message FROM messages_table WHERE chat_id=? AND message_id<? " \
+                  f"ORDER BY message_id DESC LIMIT ?"
+            self.cursor.execute(sql, [chat_id, before_id, limit])
         result = self.cursor.fetchall()
-        result = [_[0] for _ in result] if len(result) > 0 else None
+        result = result if len(result) > 0 else None
         return result
 
     def get_chats_of(self, username: str) -> list:
@@ -840,33 +938,20 @@ class DBHandler:
         :return: A list of the chats' chat ids
         :rtype: list
         """
-        # Get the unique id of the user
-        unique_id = self._get_unique_id(username)
-        sql = f"""SELECT groups_table.chat_id, groups_table.group_name
-                FROM participants_table
+        # Get the chats and the usernames of the friends of the private chats in one query
+        sql = f"""SELECT groups_table.chat_id, groups_table.group_name, user1.username, user2.username
+                FROM users_table
+                JOIN participants_table ON participants_table.participant_unique_id = users_table.unique_id
                 JOIN groups_table ON participants_table.chat_id = groups_table.chat_id
-                WHERE participants_table.participant_unique_id = ?;
+                LEFT JOIN private_chats_table ON private_chats_table.chat_id = groups_table.chat_id
+                LEFT JOIN users_table AS user1 ON user1.unique_id = private_chats_table.user1_id
+                LEFT JOIN users_table AS user2 ON user2.unique_id = private_chats_table.user2_id
+                WHERE users_table.username = ?;
                 """
-        self.cursor.execute(sql, [unique_id])
-        result = self.cursor.fetchall()
-
-        # Loop over the result and check for a private chat,
-        # for each private chat, replace the unique id with the username
+        self.cursor.execute(sql, [username])
 
         # Private chat name structure: PRIVATE%%username%%username
-
-        for i in range(len(result)):
-            # Check if it's a private chat
-            if result[i][1].startswith('PRIVATE') and len(result[i][1].split('%%')) == 3:
-                # get the unique ids of the participants
-                id1, id2 = result[i][1].split('%%')[1:]
-                sql = f"SELECT username FROM users_table WHERE unique_id=?"
-                # Get the usernames of the participants
-                self.cursor.execute(sql, [id1])
-                username1 = self.cursor.fetchall()[0][0]
-                self.cursor.execute(sql, [id2])
-                username2 = self.cursor.fetchall()[0][0]
-                # Replace the unique id with the username
-                result[i] = (result[i][0], result[i][1].replace(id1, username1).replace(id2, username2))
+        result = [(chat_id, f'PRIVATE%%{username1}%%{username2}' if username1 is not None else group_name)
+                  for chat_id, group_name, username1, username2 in self.cursor.fetchall()]
 
         return result
@@ -0,0 +1,129 @@
+import threading
+import time
+import weakref
+
+from src.handlers.db import DBHandler
+
+
+class _Lease:
+    """
+    An object that lives in a thread's local storage while the thread borrows a database handler.
+    The handler is returned to the pool when the lease is collected (when the thread ends).
+    """
+    pass
+
+
+class DBPool:
+    """
+    A thread-safe pool of long-lived database handlers.
+    Every thread borrows one handler (one sqlite connection) the first time it uses the database,
+    and the handler goes back to the pool when the thread ends.
+    """
+
+    def __init__(self, db_name, max_size=32, wait_timeout=10):
+        """
+        Creates the pool, the connections are opened lazily
+        :param db_name: The database's name
+        :param max_size: The max amount of open connections
+        :param wait_timeout: The max time to wait for a free connection (in seconds)
+        """
+        self.db_name = db_name
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+
+        self._local = threading.local()  # The handler the current thread borrowed
+        self._condition = threading.Condition()
+        self._idle = []  # The handlers that aren't borrowed
+        self._size = 0  # The amount of open handlers
+
+        # Metrics
+        self.borrows = 0  # The amount of times a handler was borrowed
+        self.waits = 0  # The amount of borrows that had to wait for a free handler
+        self.total_wait_time = 0  # The total time borrows waited (in seconds)
+        self.max_wait_time = 0  # The longest time a borrow waited (in seconds)
+
+    def initialize(self):
+        """
+        Creates the database's schema and loads the groups' members, it's done once before the handlers are borrowed
+        :return: -
+        """
+        handler = DBHandler(self.db_name, check_same_thread=False)
+        # Load the index of the groups' members before the handlers use it
+        handler.load_memberships()
+        with self._condition:
+            self._idle.append(handler)
+            self._size += 1
+
+    def get(self) -> DBHandler:
+        """
+        Returns the database handler of the current thread, a handler is borrowed from the pool on first use
+        :return: The thread's database handler
+        :raises TimeoutError: If no handler became free in time
+        """
+        handler = getattr(self._local, 'handler', None)
+        if handler is None:
+            handler = self._acquire()
+            lease = _Lease()
+            # Return the handler when the thread's local storage is cleared
+            weakref.finalize(lease, self._release, handler)
+            self._local.lease = lease
+            self._local.handler = handler
+
+        return handler
+
+    def stats(self) -> dict:
+        """
+        Returns the pool's metrics
+        :return: A dict with the pool's size, the amount of idle and borrowed handlers, and the wait times
+        """
+        with self._condition:
+            return {'size': self._size, 'max_size': self.max_size, 'idle': len(self._idle),
+                    'in_use': self._size - len(self._idle), 'borrows': self.borrows, 'waits': self.waits,
+                    'total_wait_time': self.total_wait_time, 'max_wait_time': self.max_wait_time}
+
+    def _acquire(self) -> DBHandler:
+        """
+        Borrows a handler from the pool, a new one is opened if the pool isn't full
+        :return: The borrowed handler
+        :raises TimeoutError: If no handler became free in time
+        """
+        with self._condition:
+            self.borrows += 1
+
+            if not self._idle and self._size >= self.max_size:
+                # Wait for another thread to return a handler
+                start = time.monotonic()
+                freed = self._condition.wait_for(lambda: self._idle, self.wait_timeout)
+                waited = time.monotonic() - start
+                self.waits += 1
+                self.total_wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+                if not freed:
+                    raise TimeoutError('No database connection became free in time')
+
+            if self._idle:
+                return self._idle.pop()
+
+            self._size += 1
+
+        try:
+            # The schema was already created, and the handler moves between threads
+            return DBHandler(self.db_name, create_tables=False, check_same_thread=False)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, handler: DBHandler):
+        """
+        Returns a borrowed handler to the pool
+        :param handler: The handler
+        :return: -
+        """
+        # Drop what the thread left uncommitted
+        handler.con.rollback()
+
+        with self._condition:
+            self._idle.append(handler)
+            self._condition.notify()
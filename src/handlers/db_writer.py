@@ -0,0 +1,154 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from src.handlers.db import DBHandler
+
+
+class DBWriter:
+    """
+    A single writer thread that applies the writes of all the handlers to the database.
+    The writes that are queued together are applied in one transaction and committed together (group commit),
+    every write runs in its own savepoint so a failing write doesn't undo the others.
+    """
+
+    COMMIT_INTERVAL = 0.002  # The max time to wait for more writes before a commit (in seconds)
+    MAX_BATCH = 256  # The max amount of writes in one commit
+
+    def __init__(self, db_name, commit_interval=COMMIT_INTERVAL, max_batch=MAX_BATCH, log=False):
+        """
+        Creates the writer, the thread starts with start()
+        :param db_name: The database's name
+        :param commit_interval: The max time to wait for more writes before a commit (in seconds)
+        :param max_batch: The max amount of writes in one commit
+        :param log: Whether to print the writes that failed
+        """
+        self.db_name = db_name
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.log = log
+
+        self.queue = queue.Queue()  # The queued writes (method name, args, future)
+        self.thread = None
+
+        # Metrics
+        self.writes = 0  # The amount of writes that were applied
+        self.commits = 0  # The amount of commits
+        self.largest_batch = 0  # The largest amount of writes in one commit
+
+    def start(self):
+        """
+        Starts the writer thread
+        :return: -
+        """
+        self.thread = threading.Thread(target=self._main)
+        self.thread.start()
+
+    def submit(self, method: str, *args) -> Future:
+        """
+        Queues a write
+        :param method: The name of the DBHandler method that does the write
+        :param args: The method's arguments
+        :return: A future of the method's result, it's set after the write was committed
+        """
+        future = Future()
+        self.queue.put((method, args, future))
+        return future
+
+    def close(self):
+        """
+        Commits the queued writes and stops the writer thread
+        :return: -
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self) -> dict:
+        """
+        Returns the writer's metrics
+        :return: A dict with the amount of writes and commits, the largest batch and the amount of queued writes
+        """
+        return {'writes': self.writes, 'commits': self.commits, 'largest_batch': self.largest_batch,
+                'queued': self.queue.qsize()}
+
+    def _main(self):
+        """
+        Applies the queued writes in batches
+        :return: -
+        """
+        # The handler's changes are committed by the writer
+        handler = DBHandler(self.db_name, create_tables=False)
+        handler.batched = True
+
+        running = True
+        while running:
+            write = self.queue.get()
+            if write is None:
+                break
+
+            batch = [write]
+            # Wait a little for more writes to commit with this one
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.max_batch:
+                try:
+                    write = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+                if write is None:
+                    running = False
+                    break
+                batch.append(write)
+
+            self._write(handler, batch)
+
+        handler.con.close()
+
+    def _write(self, handler: DBHandler, batch: list):
+        """
+        Applies a batch of writes in one transaction
+        :param handler: The writer's database handler
+        :param batch: A list of the writes (method name, args, future)
+        :return: -
+        """
+        results = []
+        try:
+            # Take the write lock at the start of the transaction
+            handler.cursor.execute("BEGIN IMMEDIATE")
+        except Exception as e:
+            for method, args, future in batch:
+                future.set_exception(e)
+            return
+
+        for method, args, future in batch:
+            handler.cursor.execute("SAVEPOINT write")
+            try:
+                result = getattr(handler, method)(*args)
+            except Exception as e:
+                # Undo only the failed write
+                handler.cursor.execute("ROLLBACK TO write")
+                handler.cursor.execute("RELEASE write")
+                results.append((future, None, e))
+                if self.log:
+                    print(f'DB WRITER: {method} failed -', e)
+            else:
+                handler.cursor.execute("RELEASE write")
+                results.append((future, result, None))
+
+        try:
+            handler.con.commit()
+        except Exception as e:
+            handler.con.rollback()
+            results = [(future, None, e) for future, result, error in results]
+
+        self.writes += len(batch)
+        self.commits += 1
+        self.largest_batch = max(self.largest_batch, len(batch))
+
+        # The results are only given once the writes are durable
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
@@ -1,4 +1,5 @@
 import os
+import hashlib
 from io import BytesIO
 from pathlib import Path
 
@@ -107,6 +108,36 @@ class FileHandler:
 
         return contents
 
+    @staticmethod
+    def get_file_path(chat_id: int, file_name: str):
+        """
+        Gets the path of a file in the base_path/chats/<chat_id> folder.
+
+        :param chat_id: the id of the chat associated with the file.
+        :param file_name: the name of the file.
+        :return: the path of the file, or None if it doesn't exist.
+        """
+        path = f'{FileHandler.base_path}{FileHandler.CHATS_PATH}\\{chat_id}\\{file_name}'
+        return path if os.path.exists(path) else None
+
+    @staticmethod
+    def start_upload(chat_id: int, file_name: str, file_size: int, file_hash: str = None):
+        """
+        Starts a streamed upload of a file to the base_path/chats/<chat_id> folder.
+        An upload with the hash of the file is resumable, it continues from the bytes that were already received.
+
+        :param chat_id: the id of the chat associated with the file.
+        :param file_name: the name of the file.
+        :param file_size: the size of the file (in bytes).
+        :param file_hash: the sha256 hash of the file, for a resumable upload.
+        :return: the upload object that the chunks of the file are written to.
+        """
+        dir_path = f'{FileHandler.base_path}{FileHandler.CHATS_PATH}\\{chat_id}'
+        if file_hash is None:
+            return FileUpload(f'{dir_path}\\{file_name}', file_size)
+
+        return FileUpload(f'{dir_path}\\{file_name}', file_size, file_hash, f'{dir_path}\\{file_hash}.part')
+
     @staticmethod
     def create_chat(chat_id):
         """
@@ -138,3 +169,91 @@ class FileHandler:
         buffer = BytesIO()
         image.save(buffer, format="PNG")
         return buffer.getvalue()
+
+
+class FileUpload:
+    """
+    A file that is uploaded in chunks. The chunks are written to a temporary file next to the final path
+    while the file's hash is computed, and the file is moved to its final path once it is complete.
+    The temporary file of a resumable upload is kept when the upload stops, so it can continue later.
+    """
+
+    READ_SIZE = 1024 * 1024  # The size of the reads when the temporary file of a resumed upload is hashed
+
+    def __init__(self, path: str, size: int, file_hash: str = None, tmp_path: str = None):
+        """
+        Creates (or reopens) the temporary file of an upload.
+
+        :param path: the final path of the file.
+        :param size: the size of the file (in bytes).
+        :param file_hash: the expected sha256 hash of the file, for a resumable upload.
+        :param tmp_path: the path of the temporary file, defaults to the final path with a .part suffix.
+        """
+        self.path = path
+        self.tmp_path = tmp_path if tmp_path else path + '.part'
+        self.size = size
+        self.file_hash = file_hash
+        self.resumable = file_hash is not None
+        self.received = 0  # The amount of bytes that were written
+        self.hasher = hashlib.sha256()
+
+        # Continue from the bytes that were received before
+        if self.resumable and os.path.exists(self.tmp_path) and os.path.getsize(self.tmp_path) <= size:
+            self.file = open(self.tmp_path, 'r+b')
+            while chunk := self.file.read(FileUpload.READ_SIZE):
+                self.hasher.update(chunk)
+                self.received += len(chunk)
+        else:
+            self.file = open(self.tmp_path, 'wb')
+
+    def write(self, chunk: bytes):
+        """
+        Writes the next chunk of the file.
+
+        :param chunk: the chunk's bytes.
+        :raises ValueError: if the chunk goes past the size of the file.
+        """
+        if self.received + len(chunk) > self.size:
+            raise ValueError('The upload is bigger than its declared size')
+
+        self.file.write(chunk)
+        self.hasher.update(chunk)
+        self.received += len(chunk)
+
+    def is_complete(self) -> bool:
+        """
+        Checks if all the bytes of the file were written.
+        """
+        return self.received == self.size
+
+    def commit(self) -> str:
+        """
+        Moves the complete file to its final path.
+
+        :return: the sha256 hash of the file's contents.
+        :raises ValueError: if the file's hash doesn't match the hash of a resumable upload.
+        """
+        self.file.close()
+        file_hash = self.hasher.hexdigest()
+        if self.resumable and file_hash != self.file_hash:
+            raise ValueError('The uploaded file doesn\'t match its hash')
+
+        os.replace(self.tmp_path, self.path)
+        return file_hash
+
+    def abort(self):
+        """
+        Stops the upload. The temporary file is deleted unless the upload is resumable.
+        """
+        if self.resumable:
+            self.file.close()
+        else:
+            self.discard()
+
+    def discard(self):
+        """
+        Stops the upload and deletes the temporary file.
+        """
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+
+
+class IdentityCache:
+    """
+    A bounded, thread-safe cache of the username <-> unique id mapping of the users of a database.
+    The least recently used users are evicted when the cache is full.
+    Every DBHandler of the same database shares the database's cache.
+    """
+
+    MAX_SIZE = 100000  # The max amount of users in the cache
+
+    # The caches of the databases with the key being the database's name
+    _caches = {}
+    _caches_lock = threading.Lock()
+
+    def __init__(self, max_size=MAX_SIZE):
+        """
+        Creates an empty cache
+        :param max_size: The max amount of users in the cache
+        """
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.ids = OrderedDict()  # The unique ids with the key being the username, in the order of use
+        self.usernames = {}  # The usernames with the key being the unique id
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def for_database(db_name: str):
+        """
+        Returns the shared cache of a database
+        :param db_name: The database's name
+        :return: The database's IdentityCache
+        """
+        with IdentityCache._caches_lock:
+            if db_name not in IdentityCache._caches:
+                IdentityCache._caches[db_name] = IdentityCache()
+            return IdentityCache._caches[db_name]
+
+    def get_id(self, username: str):
+        """
+        Returns the cached unique id of a user
+        :param username: The user's username
+        :return: The unique id, or None if the user isn't cached
+        """
+        with self.lock:
+            unique_id = self.ids.get(username)
+            if unique_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.ids.move_to_end(username)
+            return unique_id
+
+    def get_username(self, unique_id: int):
+        """
+        Returns the cached username of a user
+        :param unique_id: The user's unique id
+        :return: The username, or None if the user isn't cached
+        """
+        with self.lock:
+            username = self.usernames.get(unique_id)
+            if username is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.ids.move_to_end(username)
+            return username
+
+    def put(self, username: str, unique_id: int):
+        """
+        Caches a user
+        :param username: The user's username
+        :param unique_id: The user's unique id
+        :return: -
+        """
+        with self.lock:
+            self.ids[username] = unique_id
+            self.ids.move_to_end(username)
+            self.usernames[unique_id] = username
+
+            # Evict the least recently used users
+            while len(self.ids) > self.max_size:
+                evicted_username, evicted_id = self.ids.popitem(last=False)
+                self.usernames.pop(evicted_id, None)
+
+    def invalidate(self, username: str = None, unique_id: int = None):
+        """
+        Removes a user from the cache
+        :param username: The user's username
+        :param unique_id: The user's unique id
+        :return: -
+        """
+        with self.lock:
+            if username is not None:
+                unique_id = self.ids.pop(username, unique_id)
+            if unique_id is not None:
+                username = self.usernames.pop(unique_id, None)
+                self.ids.pop(username, None)
+
+    def stats(self) -> dict:
+        """
+        Returns the cache's metrics
+        :return: A dict with the amount of cached users, the hits and the misses
+        """
+        with self.lock:
+            return {'size': len(self.ids), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,125 @@
+import threading
+
+
+class MembershipIndex:
+    """
+    An in-memory index of the members of the groups of a database (chat id -> user ids, user id -> chat ids).
+    It's loaded from the participants table once, and the DBHandler methods that change the groups
+    update it after their changes are committed. Every DBHandler of the same database shares the database's index.
+    """
+
+    # The indexes of the databases with the key being the database's name
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+
+    def __init__(self):
+        """
+        Creates an empty index, it's filled by load()
+        """
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.members = {}  # The user ids of every chat (as dict keys, in the order they joined)
+        self.chats = {}  # The chat ids of every user
+
+    @staticmethod
+    def for_database(db_name: str):
+        """
+        Returns the shared index of a database
+        :param db_name: The database's name
+        :return: The database's MembershipIndex
+        """
+        with MembershipIndex._indexes_lock:
+            if db_name not in MembershipIndex._indexes:
+                MembershipIndex._indexes[db_name] = MembershipIndex()
+            return MembershipIndex._indexes[db_name]
+
+    def load(self, cursor):
+        """
+        Loads the index from the participants table, if it wasn't loaded yet
+        :param cursor: A cursor of the database
+        :return: -
+        """
+        # The lock is held while reading, so changes that are committed during the load are applied after it
+        with self.lock:
+            if self.loaded:
+                return
+
+            cursor.execute("SELECT chat_id, participant_unique_id FROM participants_table ORDER BY rowid")
+            for chat_id, user_id in cursor.fetchall():
+                self._add(chat_id, user_id)
+            self.loaded = True
+
+    def add(self, chat_id: int, user_id: int):
+        """
+        Adds a member to a chat
+        :param chat_id: The chat's id
+        :param user_id: The user's unique id
+        :return: -
+        """
+        with self.lock:
+            # The change is already in the database that the index will be loaded from
+            if self.loaded:
+                self._add(chat_id, user_id)
+
+    def remove_chat(self, chat_id: int):
+        """
+        Removes a chat and its members
+        :param chat_id: The chat's id
+        :return: -
+        """
+        chat_id = MembershipIndex._chat_key(chat_id)
+        with self.lock:
+            for user_id in self.members.pop(chat_id, {}):
+                self.chats[user_id].discard(chat_id)
+
+    def is_member(self, chat_id: int, user_id: int) -> bool:
+        """
+        Checks if a user is a member of a chat
+        :param chat_id: The chat's id
+        :param user_id: The user's unique id
+        """
+        with self.lock:
+            return user_id in self.members.get(MembershipIndex._chat_key(chat_id), {})
+
+    def get_members(self, chat_id: int) -> list:
+        """
+        Returns the members of a chat
+        :param chat_id: The chat's id
+        :return: A list of the unique ids of the members, in the order they joined
+        """
+        with self.lock:
+            return list(self.members.get(MembershipIndex._chat_key(chat_id), {}))
+
+    def get_chats(self, user_id: int) -> set:
+        """
+        Returns the chats of a user
+        :param user_id: The user's unique id
+        :return: A set of the chat ids
+        """
+        with self.lock:
+            return set(self.chats.get(user_id, ()))
+
+    @staticmethod
+    def _chat_key(chat_id):
+        """
+        Returns the key of a chat in the index
+        :param chat_id: The chat's id (an int or a string of an int)
+        :return: The chat id as an int, or None if it isn't a valid id
+        """
+        try:
+            return int(chat_id)
+        except (TypeError, ValueError):
+            return None
+
+    def _add(self, chat_id, user_id):
+        """
+        Adds a member to a chat (the lock must be held)
+        :param chat_id: The chat's id
+        :param user_id: The user's unique id
+        :return: -
+        """
+        # Ids are stored as ints, the participants table may hold them as text
+        chat_id = int(chat_id)
+        user_id = int(user_id)
+        self.members.setdefault(chat_id, {})[user_id] = None
+        self.chats.setdefault(user_id, set()).add(chat_id)
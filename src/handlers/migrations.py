@@ -0,0 +1,350 @@
+import argparse
+import sqlite3
+import time
+
+
+class Migration:
+    """
+    A step of the schema's upgrades
+    """
+
+    def __init__(self, version: int, description: str, upgrade):
+        """
+        Creates a migration step
+        :param version: The schema version the step upgrades the database to
+        :param description: A short description of the step
+        :param upgrade: A function that gets a Migrator and applies the step through it
+        """
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+
+class Migrator:
+    """
+    Applies the migration steps to a database in order. The schema's version is kept in the user_version pragma.
+    Every write goes through the migrator, so a dry run only logs what would be done.
+    Data is rewritten in small batches (each in its own short transaction) so writers are never locked out for long,
+    and the steps must be safe to run again if the migration stopped in the middle.
+    """
+
+    BATCH_SIZE = 2000  # The amount of rows that are copied in one transaction
+    BATCH_PAUSE = 0.01  # The time between batches (in seconds), the other writers take the database's lock in it
+
+    def __init__(self, con: sqlite3.Connection, dry_run=False, batch_size=BATCH_SIZE, log=False):
+        """
+        Creates a migrator for a database connection
+        :param con: The connection to the database
+        :param dry_run: Whether to only log the steps instead of applying them
+        :param batch_size: The amount of rows that are copied in one transaction
+        :param log: Whether to print the progress
+        """
+        self.con = con
+        self.cursor = con.cursor()
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.log = log
+
+    def current_version(self) -> int:
+        """
+        Returns the schema's version of the database
+        """
+        self.cursor.execute("PRAGMA user_version")
+        return self.cursor.fetchone()[0]
+
+    def pending(self, target: int = None) -> list:
+        """
+        Returns the migration steps that weren't applied to the database
+        :param target: The version to upgrade to, defaults to the latest version
+        :return: A list of the steps, in order
+        """
+        version = self.current_version()
+        return [step for step in MIGRATIONS if version < step.version and (target is None or step.version <= target)]
+
+    def migrate(self, target: int = None) -> list:
+        """
+        Applies the pending migration steps in order
+        :param target: The version to upgrade to, defaults to the latest version
+        :return: A list of the versions that were applied (or would be applied in a dry run)
+        """
+        applied = []
+        for step in self.pending(target):
+            self._print(f'Migration {step.version}: {step.description}')
+            start = time.monotonic()
+            step.upgrade(self)
+            self._set_version(step.version)
+            self._print(f'Migration {step.version} done in {time.monotonic() - start:.3f} seconds')
+            applied.append(step.version)
+
+        return applied
+
+    def execute(self, *statements):
+        """
+        Executes statements in one transaction
+        :param statements: The SQL statements
+        :return: -
+        """
+        if self.dry_run:
+            for sql in statements:
+                self._print(f'  would execute: {sql}')
+            return
+
+        with self._transaction():
+            for sql in statements:
+                self.cursor.execute(sql)
+
+    def rebuild_table(self, table: str, create_sql: str, columns: dict, indexes=()):
+        """
+        Rewrites a table into a new schema while the database stays writable.
+        The new table is created next to the old one (as <table>_new) and the rows are copied in batches by rowid,
+        triggers on the old table apply the writes that happen during the copy to the new table.
+        Then the tables are swapped, and the old table is deleted in batches.
+        The rowid of every row is kept, so a column that is an INTEGER PRIMARY KEY in the new table gets it.
+        :param table: The table's name
+        :param create_sql: The CREATE TABLE statement of the new table, with <table>_new as its name
+        :param columns: A dict of the new table's column names and the expressions (over the old table) of their values
+        :param indexes: The CREATE INDEX statements of the new table (on <table>_new)
+        :return: -
+        """
+        new_table = f'{table}_new'
+        old_table = f'{table}_old'
+        names = ', '.join(columns.keys())
+        values = ', '.join(columns.values())
+
+        if self.dry_run:
+            self.cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            rows = self.cursor.fetchone()[0]
+            self._print(f'  would rebuild {table} ({rows} rows, {-(-rows // self.batch_size)} batches): {create_sql}')
+            for sql in indexes:
+                self._print(f'  would execute: {sql}')
+            return
+
+        # Clean up after a rebuild that stopped in the middle
+        self._drop_triggers(table)
+        self.execute(f"DROP TABLE IF EXISTS {new_table}")
+        if self._table_exists(old_table):
+            self._delete_in_batches(old_table)
+
+        # Create the new table and keep it up to date with the writes to the old one
+        copy_row = f"INSERT OR REPLACE INTO {new_table} (rowid, {names}) " \
+                   f"SELECT rowid, {values} FROM {table} WHERE rowid = NEW.rowid;"
+        self.execute(create_sql, *indexes,
+                     f"CREATE TRIGGER {table}_migrate_insert AFTER INSERT ON {table} BEGIN {copy_row} END",
+                     f"CREATE TRIGGER {table}_migrate_update AFTER UPDATE ON {table} BEGIN {copy_row} END",
+                     f"CREATE TRIGGER {table}_migrate_delete AFTER DELETE ON {table} "
+                     f"BEGIN DELETE FROM {new_table} WHERE rowid = OLD.rowid; END")
+
+        # Copy the rows in batches, rows that the triggers already copied are newer
+        last_rowid = 0
+        copied = 0
+        while True:
+            self.cursor.execute(f"SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT 1 OFFSET ?",
+                                [last_rowid, self.batch_size - 1])
+            row = self.cursor.fetchone()
+            with self._transaction():
+                if row:
+                    self.cursor.execute(f"INSERT OR IGNORE INTO {new_table} (rowid, {names}) "
+                                        f"SELECT rowid, {values} FROM {table} WHERE rowid > ? AND rowid <= ?",
+                                        [last_rowid, row[0]])
+                else:
+                    self.cursor.execute(f"INSERT OR IGNORE INTO {new_table} (rowid, {names}) "
+                                        f"SELECT rowid, {values} FROM {table} WHERE rowid > ?", [last_rowid])
+            copied += self.cursor.rowcount
+            if not row:
+                break
+            last_rowid = row[0]
+            time.sleep(Migrator.BATCH_PAUSE)
+
+        # Swap the tables
+        with self._transaction():
+            for kind in ('insert', 'update', 'delete'):
+                self.cursor.execute(f"DROP TRIGGER IF EXISTS {table}_migrate_{kind}")
+            self.cursor.execute(f"ALTER TABLE {table} RENAME TO {old_table}")
+            self.cursor.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+        self._print(f'  rebuilt {table} ({copied} rows copied)')
+
+        self._delete_in_batches(old_table)
+
+    def update_in_batches(self, table: str, assignments: str):
+        """
+        Updates all the rows of a table in batches by rowid, each batch in its own short transaction
+        :param table: The table's name
+        :param assignments: The SET clause of the update (without SET)
+        :return: -
+        """
+        if self.dry_run:
+            self._print(f'  would update {table} in batches: SET {assignments}')
+            return
+
+        last_rowid = 0
+        while True:
+            self.cursor.execute(f"SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                [last_rowid, self.batch_size])
+            rowids = [row[0] for row in self.cursor.fetchall()]
+            if not rowids:
+                break
+
+            with self._transaction():
+                self.cursor.execute(f"UPDATE {table} SET {assignments} WHERE rowid >= ? AND rowid <= ?",
+                                    [rowids[0], rowids[-1]])
+            last_rowid = rowids[-1]
+            time.sleep(Migrator.BATCH_PAUSE)
+
+    def column_exists(self, table: str, column: str) -> bool:
+        """
+        Checks if a table has a column
+        :param table: The table's name
+        :param column: The column's name
+        """
+        self.cursor.execute(f"PRAGMA table_info({table})")
+        return any(row[1] == column for row in self.cursor.fetchall())
+
+    def _delete_in_batches(self, table: str):
+        """
+        Deletes a table, its rows are deleted in batches first so the database isn't locked for long
+        :param table: The table's name
+        :return: -
+        """
+        while True:
+            with self._transaction():
+                self.cursor.execute(f"DELETE FROM {table} WHERE rowid IN "
+                                    f"(SELECT rowid FROM {table} LIMIT ?)", [self.batch_size])
+            if self.cursor.rowcount < self.batch_size:
+                break
+            time.sleep(Migrator.BATCH_PAUSE)
+
+        self.execute(f"DROP TABLE {table}")
+
+    def _drop_triggers(self, table: str):
+        """
+        Drops the triggers of a table's rebuild
+        :param table: The table's name
+        :return: -
+        """
+        self.execute(*[f"DROP TRIGGER IF EXISTS {table}_migrate_{kind}" for kind in ('insert', 'update', 'delete')])
+
+    def _table_exists(self, table: str) -> bool:
+        """
+        Checks if a table exists
+        :param table: The table's name
+        """
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", [table])
+        return self.cursor.fetchone() is not None
+
+    def _set_version(self, version: int):
+        """
+        Sets the schema's version of the database
+        :param version: The version
+        :return: -
+        """
+        # Pragmas can't take parameters, the version is always an int
+        self.execute(f"PRAGMA user_version={int(version)}")
+
+    def _transaction(self):
+        """
+        Returns a context manager of a write transaction
+        """
+        # Take the write lock at the start, so the transaction doesn't fail half way because of another writer
+        if not self.con.in_transaction:
+            self.cursor.execute("BEGIN IMMEDIATE")
+        return self.con
+
+    def _print(self, message: str):
+        """
+        Prints a message if the migrator logs its progress
+        :param message: The message
+        :return: -
+        """
+        if self.log:
+            print(f'MIGRATIONS: {message}')
+
+
+def _add_lookup_indexes(migrator: Migrator):
+    """
+    Adds indexes for the lookups of the handlers
+    :param migrator: The migrator
+    :return: -
+    """
+    migrator.execute("CREATE INDEX IF NOT EXISTS participants_chat_index "
+                     "ON participants_table (chat_id, participant_unique_id)",
+                     "CREATE INDEX IF NOT EXISTS participants_user_index ON participants_table (participant_unique_id)",
+                     "CREATE INDEX IF NOT EXISTS messages_chat_index ON messages_table (chat_id, timestamp)",
+                     "CREATE INDEX IF NOT EXISTS files_hash_index ON files_table (file_hash)",
+                     "CREATE INDEX IF NOT EXISTS keys_user_chat_index ON keys_table (user_id, chat_id)",
+                     "CREATE UNIQUE INDEX IF NOT EXISTS users_username_index ON users_table (username)")
+
+
+def _add_message_ids(migrator: Migrator):
+    """
+    Gives every message an increasing id and counts the messages of every chat for the history's retention
+    :param migrator: The migrator
+    :return: -
+    """
+    # The ids are the rowids of the messages, so they keep the order the messages were added in
+    if not migrator.column_exists('messages_table', 'message_id'):
+        migrator.rebuild_table('messages_table',
+                               "CREATE TABLE messages_table_new ("
+                               "message_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                               " chat_id INT,"
+                               " timestamp INT,"
+                               " sender_unique_id INT,"
+                               " message TEXT)",
+                               {'chat_id': 'chat_id', 'timestamp': 'timestamp',
+                                'sender_unique_id': 'sender_unique_id', 'message': 'message'},
+                               ["CREATE INDEX messages_chat_message_index ON messages_table_new (chat_id, message_id)"])
+    migrator.execute("CREATE INDEX IF NOT EXISTS messages_chat_message_index ON messages_table (chat_id, message_id)",
+                     "DROP INDEX IF EXISTS messages_chat_index")
+
+    if not migrator.column_exists('groups_table', 'message_count'):
+        migrator.execute("ALTER TABLE groups_table ADD COLUMN message_count INTEGER DEFAULT 0")
+        migrator.update_in_batches('groups_table', "message_count = (SELECT COUNT(*) FROM messages_table "
+                                                   "WHERE messages_table.chat_id = groups_table.chat_id)")
+
+
+def _add_private_chats(migrator: Migrator):
+    """
+    Keeps the friends of every private chat in a table instead of only in the chat's name
+    :param migrator: The migrator
+    :return: -
+    """
+    migrator.execute("CREATE TABLE IF NOT EXISTS private_chats_table ("
+                     "chat_id INTEGER PRIMARY KEY,"
+                     " user1_id INT,"
+                     " user2_id INT)",
+                     "CREATE INDEX IF NOT EXISTS private_chats_users_index ON private_chats_table (user1_id, user2_id)",
+                     "CREATE INDEX IF NOT EXISTS friends_friend_index ON friends_table (friend_id)",
+                     # Private chat name structure: PRIVATE%%<user1_id>%%<user2_id>
+                     "INSERT OR IGNORE INTO private_chats_table (chat_id, user1_id, user2_id) "
+                     "SELECT chat_id, CAST(substr(ids, 1, instr(ids, '%%') - 1) AS INTEGER),"
+                     " CAST(substr(ids, instr(ids, '%%') + 2) AS INTEGER) "
+                     "FROM (SELECT chat_id, substr(group_name, 10) AS ids FROM groups_table "
+                     "WHERE substr(group_name, 1, 9) = 'PRIVATE%%') "
+                     "WHERE instr(ids, '%%') > 0")
+
+
+# The migration steps, in order
+MIGRATIONS = [
+    Migration(1, 'Add indexes for the lookups of the handlers', _add_lookup_indexes),
+    Migration(2, 'Add message ids and per-chat message counts', _add_message_ids),
+    Migration(3, 'Add the private chats table', _add_private_chats)
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upgrades the schema of the server\'s database')
+    parser.add_argument('db_name', nargs='?', default='strife_db', help='The database\'s name (without .db)')
+    parser.add_argument('--target', type=int, default=None, help='The version to upgrade to')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the steps')
+    parser.add_argument('--batch-size', type=int, default=Migrator.BATCH_SIZE,
+                        help='The amount of rows that are copied in one transaction')
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.db_name + '.db')
+    migrator = Migrator(con, dry_run=args.dry_run, batch_size=args.batch_size, log=True)
+    print(f'MIGRATIONS: the database is at version {migrator.current_version()}')
+    migrator.migrate(args.target)
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import threading
+import time
+import unittest
+
+from src.core.transfer_scheduler import TransferScheduler
+
+
+class TransferSchedulerTests(unittest.TestCase):
+    """
+    Tests the scheduling of the TransferScheduler
+    """
+
+    def setUp(self):
+        self.release = threading.Event()  # Lets the blocking transfers finish
+        self.done = {}  # The time every transfer finished, with the key being its name
+        self.scheduler = None
+
+    def tearDown(self):
+        self.release.set()
+        if self.scheduler is not None:
+            self.scheduler.close()
+
+    def transfer(self, name, block=False):
+        """
+        A transfer handler that records when it finished
+        :param name: The transfer's name
+        :param block: Whether to wait for the release event
+        :return: -
+        """
+        if block:
+            self.release.wait(5)
+        self.done[name] = time.monotonic()
+
+    def wait_for(self, name, timeout=2):
+        """
+        Waits for a transfer to finish
+        :param name: The transfer's name
+        :param timeout: The max time to wait (in seconds)
+        :return: True if the transfer finished in time
+        """
+        deadline = time.monotonic() + timeout
+        while name not in self.done and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return name in self.done
+
+    def test_user_at_limit_does_not_block_others(self):
+        self.scheduler = TransferScheduler('test', workers=4, byte_budget=1000, user_limit=2, max_wait=0.05)
+        self.scheduler.start()
+
+        # User a runs two long transfers and has a third queued, that waits longer than max_wait
+        for i in range(3):
+            self.scheduler.submit('a', 100, 'upload', self.transfer, f'a{i}', True)
+        time.sleep(0.2)
+
+        # User b's small transfer runs while user a is at its limit
+        self.scheduler.submit('b', 10, 'upload', self.transfer, 'b0')
+        self.assertTrue(self.wait_for('b0', timeout=0.5))
+        self.assertNotIn('a2', self.done)
+
+    def test_aged_transfer_holds_back_its_budget(self):
+        self.scheduler = TransferScheduler('test', workers=4, byte_budget=100, user_limit=2, max_wait=0.05)
+        self.scheduler.start()
+
+        # User a's transfer takes most of the budget, user b's big transfer doesn't fit and ages
+        self.scheduler.submit('a', 60, 'upload', self.transfer, 'a0', True)
+        time.sleep(0.05)
+        self.scheduler.submit('b', 80, 'upload', self.transfer, 'b0')
+        time.sleep(0.1)
+
+        # A small transfer fits the budget, but not with the aged transfer's size held back
+        self.scheduler.submit('c', 30, 'upload', self.transfer, 'c0')
+        time.sleep(0.1)
+        self.assertEqual(self.done, {})
+
+        # Once the budget is freed, the aged transfer runs first
+        self.release.set()
+        self.assertTrue(self.wait_for('c0'))
+        self.assertLess(self.done['b0'], self.done['c0'])
+
+    def test_in_flight_bytes_stay_within_budget(self):
+        self.scheduler = TransferScheduler('test', workers=4, byte_budget=100, user_limit=4)
+        self.scheduler.start()
+
+        for i in range(10):
+            self.scheduler.submit(f'user{i % 3}', 40, 'upload', self.transfer, f't{i}')
+        for i in range(10):
+            self.assertTrue(self.wait_for(f't{i}'))
+
+        self.assertLessEqual(self.scheduler.stats()['max_in_flight'], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()